@@ -0,0 +1,701 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os.path
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMPTY_COMMHISTORY_DB_DUMP = BASE_DIR + "/empty-commhistory-db"
+DEFAULT_IMPORTER = os.path.dirname(os.path.abspath(__file__)) + "/sms_db_importer.py"
+
+DEFAULT_EVENT_COUNT = 100000
+DEFAULT_RECORD_COUNT = 100000
+DEFAULT_COMMAND_EVENT_COUNTS = "10000,100000,1000000"
+DEFAULT_EXPORT_EVENT_COUNT = 10000
+DEFAULT_GROUP_COUNT = 500
+DEFAULT_MMS_PCT = 5
+DEFAULT_GROUP_MMS_PCT = 10
+DEFAULT_ATT_BYTES = 10000
+DEFAULT_ATTS_PER_MMS = 2
+REMOTE_MMS_PARTS_DIR = "/home/nemo/.local/share/commhistory/data"
+LOCAL_UID = "/org/freedesktop/Telepathy/Account/ring/tel/ril_0"
+MY_NUMBER = "5550001111"
+
+usage = """Benchmarks for sms_db_importer.py
+Usage:
+  {appName} rows [OPTS] [IMPORTER_PY IMPORTER_PY ..]
+    build a synthetic commhistory DB, and print the per-row cost of the
+    per-row hot paths (db readers, toCsv, MMS.parseParts, cleanNumber,
+    and the import filter/sort/--limit step on unsorted texts)
+    for each IMPORTER_PY, so two revisions can be compared, e.g.:
+      git show HEAD~1:comm-tools/sms_db_importer.py > /tmp/old.py
+      {appName} rows /tmp/old.py comm-tools/sms_db_importer.py
+    (default IMPORTER_PY is {defaultImporter})
+
+    OPTS:
+      --events          number of SMS events, and of call events (default is {eventCount})
+      --seed            random seed for the synthetic data (default is 0)
+
+  {appName} records [OPTS] [IMPORTER_PY IMPORTER_PY ..]
+    allocate Text, Call, MMS and MMSPart records as the db readers do,
+    and print the bytes per record (measured with tracemalloc) for each IMPORTER_PY
+    field values are shared between records, so this is the per-record object overhead
+
+    OPTS:
+      --records         number of records of each type (default is {recordCount})
+
+  {appName} commands [OPTS] [IMPORTER_PY IMPORTER_PY ..]
+    for each number of events in EVENT_COUNTS, generate a synthetic SMS CSV, calls CSV,
+    MMS_MSG_DIR, MMS_PARTS_DIR and CONTACTS_CSV, and run each IMPORTER_PY command on them:
+      import-to-db-sms, import-to-db-calls, import-to-db-mms into a new DB_FILE,
+      export-from-db-sms, export-from-db-calls, export-from-db-mms and export-all
+        from that DB_FILE,
+      list-texts with CONTACTS_CSV, and mms-hash of one MMS
+    print the elapsed time, rows/sec and peak RSS of each command,
+    and optionally append them to RESULTS_FILE as one JSON object per line
+    (default IMPORTER_PY is {defaultImporter})
+
+    OPTS:
+      --events          comma-separated EVENT_COUNTS (default is {commandEventCounts})
+                        MMS_PCT% of the events are MMS,
+                        the rest are split evenly between SMS and calls
+      --groups          number of distinct remote numbers (default is {groupCount})
+      --mms-pct         percentage of events that are MMS (default is {mmsPct})
+      --group-mms-pct   percentage of MMS with 2-4 remote numbers (default is {groupMmsPct})
+      --att-bytes       average size of an MMS att file in bytes (default is {attBytes})
+      --atts-per-mms    max att files per MMS, 0 to ATTS_PER_MMS (default is {attsPerMms})
+      --seed            random seed for the synthetic data (default is 0)
+      --work-dir        generate into WORK_DIR and keep it, instead of a removed temp dir
+      --results         append one JSON object per command run to RESULTS_FILE
+
+  {appName} exports [OPTS] IMPORTER_PY IMPORTER_PY [IMPORTER_PY ..]
+    regression check of the db readers across revisions:
+    generate synthetic inputs as in `commands`, import them into one DB_FILE
+    with the first IMPORTER_PY, then run export-from-db-sms, export-from-db-calls and
+    export-from-db-mms from that DB_FILE with each IMPORTER_PY
+    the CSV files and MMS_MSG_DIR trees must be byte-identical to those of the first
+    IMPORTER_PY, prints OK or DIFFERS for each, and exits 1 if any differ or fail, e.g.:
+      git show HEAD~1:comm-tools/sms_db_importer.py > /tmp/old.py
+      {appName} exports /tmp/old.py comm-tools/sms_db_importer.py
+
+    OPTS:
+      --events          number of events (default is {exportEventCount})
+      --group-mms-pct   percentage of MMS with 2-4 remote numbers (default is 0,
+                        revisions before multi-party group support read them differently)
+      --groups, --mms-pct, --att-bytes, --atts-per-mms, --seed, --work-dir
+                        same as for `commands`
+""".format(appName=os.path.basename(__file__),
+  defaultImporter=DEFAULT_IMPORTER,
+  eventCount=DEFAULT_EVENT_COUNT,
+  recordCount=DEFAULT_RECORD_COUNT,
+  commandEventCounts=DEFAULT_COMMAND_EVENT_COUNTS,
+  exportEventCount=DEFAULT_EXPORT_EVENT_COUNT,
+  groupCount=DEFAULT_GROUP_COUNT,
+  mmsPct=DEFAULT_MMS_PCT,
+  groupMmsPct=DEFAULT_GROUP_MMS_PCT,
+  attBytes=DEFAULT_ATT_BYTES,
+  attsPerMms=DEFAULT_ATTS_PER_MMS)
+
+class MyArgumentParser(argparse.ArgumentParser):
+  def error(self, message):
+    print(usage + "\nERROR: " + message)
+    quit(1)
+
+def main():
+  parser = MyArgumentParser(add_help=False)
+  subparsers = parser.add_subparsers(dest='COMMAND')
+  rowsSubParser = subparsers.add_parser('rows')
+  rowsSubParser.add_argument('IMPORTER_PY', nargs='*')
+  rowsSubParser.add_argument('--events', type=int, default=DEFAULT_EVENT_COUNT)
+  rowsSubParser.add_argument('--seed', type=int, default=0)
+  recordsSubParser = subparsers.add_parser('records')
+  recordsSubParser.add_argument('IMPORTER_PY', nargs='*')
+  recordsSubParser.add_argument('--records', type=int, default=DEFAULT_RECORD_COUNT)
+  commandsSubParser = subparsers.add_parser('commands')
+  commandsSubParser.add_argument('IMPORTER_PY', nargs='*')
+  commandsSubParser.add_argument('--events', default=DEFAULT_COMMAND_EVENT_COUNTS)
+  commandsSubParser.add_argument('--groups', type=int, default=DEFAULT_GROUP_COUNT)
+  commandsSubParser.add_argument('--mms-pct', type=int, default=DEFAULT_MMS_PCT)
+  commandsSubParser.add_argument('--group-mms-pct', type=int, default=DEFAULT_GROUP_MMS_PCT)
+  commandsSubParser.add_argument('--att-bytes', type=int, default=DEFAULT_ATT_BYTES)
+  commandsSubParser.add_argument('--atts-per-mms', type=int, default=DEFAULT_ATTS_PER_MMS)
+  commandsSubParser.add_argument('--seed', type=int, default=0)
+  commandsSubParser.add_argument('--work-dir')
+  commandsSubParser.add_argument('--results')
+  exportsSubParser = subparsers.add_parser('exports')
+  exportsSubParser.add_argument('IMPORTER_PY', nargs='*')
+  exportsSubParser.add_argument('--events', type=int, default=DEFAULT_EXPORT_EVENT_COUNT)
+  exportsSubParser.add_argument('--groups', type=int, default=DEFAULT_GROUP_COUNT)
+  exportsSubParser.add_argument('--mms-pct', type=int, default=DEFAULT_MMS_PCT)
+  exportsSubParser.add_argument('--group-mms-pct', type=int, default=0)
+  exportsSubParser.add_argument('--att-bytes', type=int, default=DEFAULT_ATT_BYTES)
+  exportsSubParser.add_argument('--atts-per-mms', type=int, default=DEFAULT_ATTS_PER_MMS)
+  exportsSubParser.add_argument('--seed', type=int, default=0)
+  exportsSubParser.add_argument('--work-dir')
+  args = parser.parse_args()
+
+  if args.COMMAND in ["rows", "records", "commands", "exports"]:
+    importerFiles = args.IMPORTER_PY
+    if len(importerFiles) == 0:
+      importerFiles = [DEFAULT_IMPORTER]
+    importers = [loadImporter(f, i) for (i, f) in enumerate(importerFiles)]
+
+  if args.COMMAND == "rows":
+    random.seed(args.seed)
+    tmpDir = tempfile.mkdtemp(prefix="sms-db-bench-")
+    dbFile = tmpDir + "/commhistory.db"
+    print("generating " + str(args.events) + " SMS + " + str(args.events) + " calls"
+      + " in " + dbFile)
+    createSyntheticDb(dbFile, args.events, args.events)
+
+    print("%-24s %-40s %12s" % ("BENCH", "IMPORTER_PY", "usec/row"))
+    for (importerFile, importer) in zip(importerFiles, importers):
+      for (benchName, benchFct) in ROWS_BENCHMARKS:
+        result = benchFct(importer, dbFile, args.events)
+        if result == None:
+          print("%-24s %-40s %12s" % (benchName, importerFile, "n/a"))
+        else:
+          (rowCount, elapsedS) = result
+          print("%-24s %-40s %12.2f" % (
+            benchName, importerFile, elapsedS * 1000000.0 / rowCount))
+
+    os.remove(dbFile)
+    os.rmdir(tmpDir)
+  elif args.COMMAND == "records":
+    print("%-24s %-40s %12s" % ("RECORD", "IMPORTER_PY", "bytes/record"))
+    for (importerFile, importer) in zip(importerFiles, importers):
+      for (recordName, recordFct) in RECORD_BENCHMARKS:
+        byteCount = measureAllocatedBytes(recordFct, importer, args.records)
+        print("%-24s %-40s %12.1f" % (
+          recordName, importerFile, byteCount / args.records))
+  elif args.COMMAND == "commands":
+    try:
+      eventCounts = [int(c) for c in args.events.split(",")]
+    except ValueError:
+      parser.error("invalid --events: " + args.events)
+    if args.groups < 1:
+      parser.error("--groups must be a positive integer")
+
+    if args.work_dir == None:
+      workDir = tempfile.mkdtemp(prefix="sms-db-bench-")
+    else:
+      workDir = args.work_dir
+      os.makedirs(workDir, exist_ok=True)
+
+    print("%-20s %9s %-40s %9s %9s %11s %9s" % (
+      "COMMAND", "EVENTS", "IMPORTER_PY", "rows", "seconds", "rows/sec", "RSS(MiB)"))
+    for eventCount in eventCounts:
+      random.seed(args.seed)
+      inputDir = workDir + "/events-" + str(eventCount)
+      inputs = generateSyntheticInputs(importers[0], inputDir, eventCount,
+        args.groups, args.mms_pct, args.group_mms_pct, args.att_bytes, args.atts_per_mms)
+      for (i, (importerFile, importer)) in enumerate(zip(importerFiles, importers)):
+        runDir = inputDir + "/run-" + str(i)
+        for result in runCommandBenchmarks(importerFile, inputs, runDir):
+          result["events"] = eventCount
+          printCommandResult(result)
+          if args.results != None:
+            with open(args.results, 'a') as f:
+              f.write(json.dumps(result, sort_keys=True) + "\n")
+
+    if args.work_dir == None:
+      shutil.rmtree(workDir)
+  elif args.COMMAND == "exports":
+    if len(importerFiles) < 2:
+      parser.error("exports needs at least two IMPORTER_PY to compare")
+    if args.groups < 1:
+      parser.error("--groups must be a positive integer")
+
+    if args.work_dir == None:
+      workDir = tempfile.mkdtemp(prefix="sms-db-bench-")
+    else:
+      workDir = args.work_dir
+      os.makedirs(workDir, exist_ok=True)
+
+    random.seed(args.seed)
+    inputDir = workDir + "/events-" + str(args.events)
+    inputs = generateSyntheticInputs(importers[0], inputDir, args.events,
+      args.groups, args.mms_pct, args.group_mms_pct, args.att_bytes, args.atts_per_mms)
+    ok = compareExports(importerFiles, inputs, inputDir)
+
+    if args.work_dir == None:
+      shutil.rmtree(workDir)
+    if not ok:
+      quit(1)
+  else:
+    print(usage + "\nERROR: missing <COMMAND>")
+    quit(1)
+
+def loadImporter(importerFile, index):
+  spec = importlib.util.spec_from_file_location(
+    "sms_db_importer_bench_" + str(index), importerFile)
+  importer = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(importer)
+  importer.VERBOSE = False
+  importer.MY_NUMBER = MY_NUMBER
+  return importer
+
+def randomNumber():
+  return random.choice(["+1", "1", ""]) + "555" + "%07d" % random.randint(0, 9999999)
+
+def createSyntheticDb(dbFile, smsCount, callCount):
+  conn = sqlite3.connect(dbFile)
+  with open(EMPTY_COMMHISTORY_DB_DUMP, 'r') as f:
+    conn.executescript(f.read())
+
+  numbers = [randomNumber() for i in range(200)]
+  conn.executemany("INSERT INTO Groups (id, localUid, remoteUids, type, chatName, lastModified)"
+    + " VALUES (?, ?, ?, 0, '', 0)",
+    [(i+1, LOCAL_UID, numbers[i]) for i in range(len(numbers))])
+
+  eventRows = []
+  eventPropRows = []
+  dateMillis = 1500000000000
+  for i in range(smsCount + callCount):
+    eventId = i + 1
+    isSMS = i < smsCount
+    dateMillis += random.randint(1000, 600000)
+    groupIdx = random.randint(0, len(numbers)-1)
+    eventRows.append((eventId, 2 if isSMS else 3,
+      int(dateMillis/1000), int(dateMillis/1000) + (0 if isSMS else random.randint(0, 3600)),
+      random.choice([1, 2]), random.choice([0, 0, 0, 1]),
+      LOCAL_UID, numbers[groupIdx], "synthetic message body " + str(i) if isSMS else "",
+      groupIdx + 1 if isSMS else None, random.choice(["", "", "rejected"])))
+    eventPropRows.append((eventId, 'external_date_sent_millis', dateMillis))
+  conn.executemany("INSERT INTO Events"
+    + " (id, type, startTime, endTime, direction, isMissedCall,"
+    + "  localUid, remoteUid, freeText, groupId, headers)"
+    + " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", eventRows)
+  conn.executemany("INSERT INTO EventProperties (eventId, key, value) VALUES (?, ?, ?)",
+    eventPropRows)
+  conn.commit()
+  conn.close()
+
+def benchReadSMS(importer, dbFile, eventCount):
+  startTime = time.time()
+  rowCount = 0
+  for txt in importer.readTextsFromCommHistory(dbFile):
+    txt.toCsv()
+    rowCount += 1
+  return (rowCount, time.time() - startTime)
+
+def benchReadCalls(importer, dbFile, eventCount):
+  startTime = time.time()
+  rowCount = 0
+  for call in importer.readCallsFromCommHistory(dbFile):
+    call.toCsv()
+    rowCount += 1
+  return (rowCount, time.time() - startTime)
+
+def benchParseMMSParts(importer, dbFile, eventCount):
+  msgs = []
+  for i in range(eventCount):
+    msg = importer.MMS("/nonexistent-mms-parts-dir")
+    msg.date_millis = 1500000000000 + i * 1000
+    part = importer.MMSPart()
+    part.part_type = "image/jpeg"
+    part.filepath = "%s/msg-%d-%d/IMG_%d.jpg" % (
+      REMOTE_MMS_PARTS_DIR, msg.date_millis/1000, i, i)
+    msg.parts.append(part)
+    msgs.append(msg)
+
+  startTime = time.time()
+  for msg in msgs:
+    msg.parseParts(skipChecksum=True)
+  return (len(msgs), time.time() - startTime)
+
+def benchNumbers(importer, dbFile, eventCount):
+  numbers = [randomNumber() for i in range(eventCount)]
+  startTime = time.time()
+  for number in numbers:
+    importer.maybePrependUSANumber(importer.cleanNumber(number))
+  return (len(numbers), time.time() - startTime)
+
+#bytes still allocated after building recordCount records, and keeping them
+def measureAllocatedBytes(recordFct, importer, recordCount):
+  tracemalloc.start()
+  startBytes = tracemalloc.get_traced_memory()[0]
+  records = [recordFct(importer) for i in range(recordCount)]
+  endBytes = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  del records
+  return endBytes - startBytes
+
+SAMPLE_NUMBER = "5551234567"
+SAMPLE_DATE_MILLIS = 1500000000000
+SAMPLE_DATE_FORMAT = "2017-07-14 02:40:00"
+SAMPLE_BODY = "synthetic message body"
+SAMPLE_PART_TYPE = "image/jpeg"
+SAMPLE_PART_FILEPATH = REMOTE_MMS_PARTS_DIR + "/msg-1500000000-1/IMG_0001.jpg"
+
+def newText(importer):
+  return importer.Text(SAMPLE_NUMBER, SAMPLE_DATE_MILLIS, SAMPLE_DATE_MILLIS,
+    "sms", importer.SMS_DIR.INC, SAMPLE_DATE_FORMAT, SAMPLE_BODY)
+
+def newCall(importer):
+  return importer.Call(SAMPLE_NUMBER, SAMPLE_DATE_MILLIS,
+    importer.CALL_DIR.INC, SAMPLE_DATE_FORMAT, " 0h  1m  2s")
+
+def newMMSPart(importer):
+  part = importer.MMSPart()
+  part.part_type = SAMPLE_PART_TYPE
+  part.filepath = SAMPLE_PART_FILEPATH
+  return part
+
+#an MMS as returned by readMMSFromCommHistory, with one smil part and one att
+def newMMS(importer):
+  msg = importer.MMS("/nonexistent-mms-parts-dir")
+  msg.from_number = SAMPLE_NUMBER
+  msg.to_numbers.append(MY_NUMBER)
+  msg.date_millis = SAMPLE_DATE_MILLIS
+  msg.date_sent_millis = SAMPLE_DATE_MILLIS
+  msg.direction = importer.MMS_DIR.INC
+  msg.date_format = SAMPLE_DATE_FORMAT
+  msg.subject = "NoSubject"
+  msg.body = SAMPLE_BODY
+  smilPart = importer.MMSPart()
+  smilPart.part_type = "application/smil"
+  msg.parts.append(smilPart)
+  msg.parts.append(newMMSPart(importer))
+  msg.parseParts(skipChecksum=True)
+  return msg
+
+#an MMS with only a smil part, e.g.: a group text with the body in freeText
+def newMMSNoAtts(importer):
+  msg = importer.MMS("/nonexistent-mms-parts-dir")
+  msg.from_number = SAMPLE_NUMBER
+  msg.to_numbers.append(MY_NUMBER)
+  msg.date_millis = SAMPLE_DATE_MILLIS
+  msg.date_sent_millis = SAMPLE_DATE_MILLIS
+  msg.direction = importer.MMS_DIR.INC
+  msg.date_format = SAMPLE_DATE_FORMAT
+  msg.subject = "NoSubject"
+  msg.body = SAMPLE_BODY
+  smilPart = importer.MMSPart()
+  smilPart.part_type = "application/smil"
+  msg.parts.append(smilPart)
+  msg.parseParts(skipChecksum=True)
+  return msg
+
+RECORD_BENCHMARKS = [ ("Text",        newText)
+                    , ("Call",        newCall)
+                    , ("MMSPart",     newMMSPart)
+                    , ("MMS",         newMMS)
+                    , ("MMS-no-atts", newMMSNoAtts)
+                    ]
+
+def newShuffledTexts(importer, eventCount):
+  texts = []
+  for i in range(eventCount):
+    dateMillis = SAMPLE_DATE_MILLIS + random.randint(0, 10**10)
+    texts.append(importer.Text(randomNumber(), dateMillis, dateMillis,
+      "S", importer.SMS_DIR.INC, SAMPLE_DATE_FORMAT, SAMPLE_BODY))
+  return texts
+
+def benchPrepareTexts(importer, dbFile, eventCount, limit):
+  if not hasattr(importer, 'prepareTextsForImport'):
+    return None
+  texts = newShuffledTexts(importer, eventCount)
+  startTime = time.time()
+  with contextlib.redirect_stdout(io.StringIO()):
+    importer.prepareTextsForImport(texts, limit)
+  return (len(texts), time.time() - startTime)
+
+def benchPrepareTextsAll(importer, dbFile, eventCount):
+  return benchPrepareTexts(importer, dbFile, eventCount, 0)
+
+def benchPrepareTextsLimit(importer, dbFile, eventCount):
+  return benchPrepareTexts(importer, dbFile, eventCount, int(eventCount/100))
+
+ROWS_BENCHMARKS = [ ("read-sms+toCsv",    benchReadSMS)
+                  , ("read-calls+toCsv",  benchReadCalls)
+                  , ("mms-parseParts",    benchParseMMSParts)
+                  , ("cleanNumber",       benchNumbers)
+                  , ("prep-sms",          benchPrepareTextsAll)
+                  , ("prep-sms-limit-1pct", benchPrepareTextsLimit)
+                  ]
+
+BODY_WORDS = ["ok", "see you soon", "lol", "on my way", "call me", "running late",
+  "did you get my message?", "sure, sounds good", "thanks!", "\u2603", "\U0001f600",
+  "she said \"maybe\"", "a\\b", "line one\nline two", "10% off, today only"]
+
+def randomBody():
+  return " ".join([random.choice(BODY_WORDS) for i in range(random.randint(1, 12))])
+
+def formatDateMillis(dateMillis):
+  return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dateMillis/1000))
+
+#SMS CSV, calls CSV, MMS_MSG_DIR, MMS_PARTS_DIR and CONTACTS_CSV, as written by the exporters
+#  MMS att files are hardlinked into MMS_PARTS_DIR, so they only use disk space once
+#  returns the paths and row counts, for runCommandBenchmarks()
+def generateSyntheticInputs(importer, inputDir, eventCount,
+                            groupCount, mmsPct, groupMmsPct, attBytes, attsPerMms):
+  mmsCount = int(eventCount * mmsPct / 100)
+  smsCount = int((eventCount - mmsCount) / 2)
+  callCount = eventCount - mmsCount - smsCount
+  print("generating " + str(smsCount) + " SMS + " + str(callCount) + " calls"
+    + " + " + str(mmsCount) + " MMS in " + inputDir)
+
+  inputs = { "smsCsv":      inputDir + "/sms.csv"
+           , "callsCsv":    inputDir + "/calls.csv"
+           , "mmsMsgDir":   inputDir + "/mms-msg"
+           , "mmsPartsDir": inputDir + "/mms-parts"
+           , "contactsCsv": inputDir + "/contacts.csv"
+           , "smsCount":    smsCount
+           , "callCount":   callCount
+           , "mmsCount":    mmsCount
+           , "mmsHashAtts": []
+           }
+  if os.path.isdir(inputDir):
+    shutil.rmtree(inputDir)
+  os.makedirs(inputs["mmsMsgDir"])
+  os.makedirs(inputs["mmsPartsDir"])
+
+  numbers = sorted(set([randomNumber() for i in range(groupCount)]))
+  with open(inputs["contactsCsv"], 'w') as f:
+    for (i, number) in enumerate(numbers):
+      f.write(importer.cleanNumber(number) + ",Contact " + str(i) + "\n")
+
+  startMillis = 1500000000000
+  with open(inputs["smsCsv"], 'w') as f:
+    dateMillis = startMillis
+    for i in range(smsCount):
+      dateMillis += random.randint(1, 600000)
+      #the db readers take both dates from external_date_sent_millis, so keep them equal
+      txt = importer.Text(random.choice(numbers), dateMillis, dateMillis,
+        "S", random.choice(list(importer.SMS_DIR)), formatDateMillis(dateMillis), randomBody())
+      f.write(txt.toCsv() + "\n")
+
+  with open(inputs["callsCsv"], 'w') as f:
+    dateMillis = startMillis
+    for i in range(callCount):
+      #call log dates are whole seconds, from Events.startTime
+      dateMillis += random.randint(1, 1200) * 1000
+      durationS = random.choice([0, random.randint(1, 3600)])
+      call = importer.Call(random.choice(numbers), dateMillis, random.choice(list(importer.CALL_DIR)),
+        formatDateMillis(dateMillis),
+        " %dh %02dm %02ds" % (durationS / 3600, durationS / 60 % 60, durationS % 60))
+      f.write(call.toCsv() + "\n")
+
+  dateMillis = startMillis
+  for i in range(mmsCount):
+    dateMillis += random.randint(1000, 6000000)
+    msg = importer.MMS(inputs["mmsPartsDir"])
+    msg.direction = random.choice([importer.MMS_DIR.OUT, importer.MMS_DIR.INC])
+    if random.randint(1, 100) <= groupMmsPct:
+      remoteNumbers = random.sample(numbers, min(len(numbers), random.randint(2, 4)))
+    else:
+      remoteNumbers = [random.choice(numbers)]
+    remoteNumbers = [importer.cleanNumber(n) for n in remoteNumbers]
+    if msg.direction == importer.MMS_DIR.OUT:
+      msg.from_number = MY_NUMBER
+      msg.to_numbers = remoteNumbers
+      prefixNumbers = "-".join(remoteNumbers)
+    else:
+      msg.from_number = remoteNumbers[0]
+      msg.to_numbers = [MY_NUMBER] + remoteNumbers[1:]
+      prefixNumbers = remoteNumbers[0]
+    msg.date_millis = dateMillis
+    msg.date_sent_millis = dateMillis
+    msg.subject = random.choice(["NoSubject", "", "pics"])
+    msg.body = randomBody()
+
+    tmpMsgDir = inputs["mmsMsgDir"] + "/tmp-" + str(i)
+    os.mkdir(tmpMsgDir)
+    attFiles = {}
+    for k in range(random.randint(0, attsPerMms)):
+      attName = random.choice(["IMG_%04d.jpg", "VID_%04d.3gp", "text_%04d.txt"]) % k
+      attFiles[attName] = tmpMsgDir + "/" + attName
+      with open(attFiles[attName], 'wb') as f:
+        f.write(random.randbytes(random.randint(int(attBytes/2), int(attBytes*3/2))))
+    msg.checksum = importer.generateMMSChecksum(msg.subject, msg.body, attFiles)
+
+    msgDir = inputs["mmsMsgDir"] + "/" + msg.getMsgDirName()
+    os.rename(tmpMsgDir, msgDir)
+    partsDir = inputs["mmsPartsDir"] + "/" + str(i + 1)
+    os.mkdir(partsDir)
+    partPrefix = "%d_%s_%s_%s_" % (
+      msg.date_millis, prefixNumbers, msg.direction.name, msg.checksum)
+    for attName in sorted(attFiles.keys()):
+      msg.attFiles[attName] = msgDir + "/" + attName
+      os.link(msg.attFiles[attName], partsDir + "/" + partPrefix + attName)
+    with open(msgDir + "/info", 'w') as f:
+      f.write(msg.getInfo())
+    if len(msg.attFiles) > len(inputs["mmsHashAtts"]):
+      inputs["mmsHashSubject"] = msg.subject
+      inputs["mmsHashBody"] = msg.body
+      inputs["mmsHashAtts"] = [msg.attFiles[attName] for attName in sorted(msg.attFiles.keys())]
+  return inputs
+
+#(name, args after IMPORTER_PY, rows processed) for each command, in the order they are run
+def getCommandBenchmarks(inputs, runDir):
+  db = runDir + "/commhistory.db"
+  outDir = runDir + "/out"
+  return [ ("import-to-db-sms",
+             ["import-to-db-sms", db, inputs["smsCsv"]], inputs["smsCount"])
+         , ("import-to-db-calls",
+             ["import-to-db-calls", db, inputs["callsCsv"]], inputs["callCount"])
+         , ("import-to-db-mms",
+             ["import-to-db-mms", db, inputs["mmsMsgDir"], inputs["mmsPartsDir"]],
+             inputs["mmsCount"])
+         , ("export-from-db-sms",
+             ["export-from-db-sms", db, outDir + "/sms.csv"], inputs["smsCount"])
+         , ("export-from-db-calls",
+             ["export-from-db-calls", db, outDir + "/calls.csv"], inputs["callCount"])
+         , ("export-from-db-mms",
+             ["export-from-db-mms", db, outDir + "/mms-msg", inputs["mmsPartsDir"]],
+             inputs["mmsCount"])
+         , ("export-all",
+             ["export-all", db, outDir + "/all/sms.csv", outDir + "/all/calls.csv",
+               outDir + "/all/mms-msg", inputs["mmsPartsDir"]],
+             inputs["smsCount"] + inputs["callCount"] + inputs["mmsCount"])
+         , ("list-texts",
+             ["list-texts", db, inputs["contactsCsv"]], inputs["smsCount"] + inputs["mmsCount"])
+         , ("mms-hash",
+             ["mms-hash", inputs.get("mmsHashSubject", ""), inputs.get("mmsHashBody", "")]
+               + inputs["mmsHashAtts"], len(inputs["mmsHashAtts"]))
+         ]
+
+#run each command of IMPORTER_PY against a new DB_FILE in runDir, with caches in runDir
+#  HOME is set to runDir, so the default ~/.cache files are used there,
+#  since older IMPORTER_PY revisions do not accept the cache file options
+#  each command output is written to runDir/<COMMAND>.log
+def runCommandBenchmarks(importerFile, inputs, runDir):
+  if os.path.isdir(runDir):
+    shutil.rmtree(runDir)
+  os.makedirs(runDir + "/out/mms-msg")
+  os.makedirs(runDir + "/out/all/mms-msg")
+  conn = sqlite3.connect(runDir + "/commhistory.db")
+  with open(EMPTY_COMMHISTORY_DB_DUMP, 'r') as f:
+    conn.executescript(f.read())
+  conn.close()
+
+  optArgs = ["--my-number", MY_NUMBER]
+  env = dict(os.environ)
+  env["HOME"] = os.path.abspath(runDir)
+  results = []
+  for (commandName, commandArgs, rowCount) in getCommandBenchmarks(inputs, runDir):
+    cmd = [sys.executable, importerFile] + commandArgs + optArgs
+    (exitCode, elapsedS, maxRssKiB) = runCommand(cmd, runDir + "/" + commandName + ".log", env)
+    results.append({ "command":     commandName
+                   , "importer":    importerFile
+                   , "rows":        rowCount
+                   , "elapsed_s":   round(elapsedS, 4)
+                   , "rows_per_s":  round(rowCount / elapsedS, 1) if elapsedS > 0 else None
+                   , "max_rss_kib": maxRssKiB
+                   , "exit_code":   exitCode
+                   })
+  return results
+
+#import inputs into one DB_FILE with the first of importerFiles, export it with each of them,
+#  and print whether each export is byte-identical to that of the first
+#  returns False if any export differs or fails
+def compareExports(importerFiles, inputs, inputDir):
+  dbFile = inputDir + "/exports.db"
+  conn = sqlite3.connect(dbFile)
+  with open(EMPTY_COMMHISTORY_DB_DUMP, 'r') as f:
+    conn.executescript(f.read())
+  conn.close()
+
+  env = dict(os.environ)
+  env["HOME"] = os.path.abspath(inputDir)
+  optArgs = ["--my-number", MY_NUMBER]
+  importArgs = [ ["import-to-db-sms", dbFile, inputs["smsCsv"]]
+               , ["import-to-db-calls", dbFile, inputs["callsCsv"]]
+               , ["import-to-db-mms", dbFile, inputs["mmsMsgDir"], inputs["mmsPartsDir"]]
+               ]
+  for commandArgs in importArgs:
+    logFile = inputDir + "/exports-" + commandArgs[0] + ".log"
+    (exitCode, elapsedS, maxRssKiB) = runCommand(
+      [sys.executable, importerFiles[0]] + commandArgs + optArgs, logFile, env)
+    if exitCode != 0:
+      print("ERROR: " + commandArgs[0] + " failed for " + importerFiles[0] + ", see " + logFile)
+      return False
+
+  ok = True
+  expected = None
+  print("%-20s %-40s %s" % ("COMMAND", "IMPORTER_PY", "OUTPUT"))
+  for (i, importerFile) in enumerate(importerFiles):
+    outDir = inputDir + "/exports-" + str(i)
+    if os.path.isdir(outDir):
+      shutil.rmtree(outDir)
+    os.makedirs(outDir + "/mms-msg")
+    exports = [ ("export-from-db-sms", [dbFile, outDir + "/sms.csv"], outDir + "/sms.csv")
+              , ("export-from-db-calls", [dbFile, outDir + "/calls.csv"], outDir + "/calls.csv")
+              , ("export-from-db-mms", [dbFile, outDir + "/mms-msg", inputs["mmsPartsDir"]],
+                  outDir + "/mms-msg")
+              ]
+    outputs = {}
+    for (commandName, commandArgs, outFile) in exports:
+      logFile = outDir + "/" + commandName + ".log"
+      (exitCode, elapsedS, maxRssKiB) = runCommand(
+        [sys.executable, importerFile, commandName] + commandArgs + optArgs, logFile, env)
+      if exitCode != 0:
+        outputs[commandName] = None
+        result = "FAILED(" + str(exitCode) + "), see " + logFile
+      else:
+        outputs[commandName] = getFileTreeDigests(outFile)
+        if expected == None:
+          result = str(len(outputs[commandName])) + " files"
+        elif outputs[commandName] == expected[commandName]:
+          result = "OK"
+        else:
+          result = "DIFFERS from " + importerFiles[0] + ", see " + outFile
+      if outputs[commandName] == None or (
+          expected != None and outputs[commandName] != expected[commandName]):
+        ok = False
+      print("%-20s %-40s %s" % (commandName, importerFile, result))
+    if expected == None:
+      expected = outputs
+  return ok
+
+#{relative path: sha256} of a file, or of each file under a dir
+def getFileTreeDigests(path):
+  if os.path.isfile(path):
+    files = [(os.path.basename(path), path)]
+  else:
+    files = []
+    for (dirPath, dirNames, fileNames) in os.walk(path):
+      for fileName in fileNames:
+        filePath = os.path.join(dirPath, fileName)
+        files.append((os.path.relpath(filePath, path), filePath))
+  digests = {}
+  for (relPath, filePath) in files:
+    with open(filePath, 'rb') as f:
+      digests[relPath] = hashlib.sha256(f.read()).hexdigest()
+  return digests
+
+#(exitCode, elapsedS, maxRssKiB) of cmd, with stdout+stderr written to logFile
+def runCommand(cmd, logFile, env=None):
+  with open(logFile, 'w') as log:
+    startTime = time.time()
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+    (pid, status, rusage) = os.wait4(proc.pid, 0)
+    elapsedS = time.time() - startTime
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  return (proc.returncode, elapsedS, rusage.ru_maxrss)
+
+def printCommandResult(result):
+  if result["exit_code"] != 0:
+    rate = "FAILED(" + str(result["exit_code"]) + ")"
+  elif result["rows_per_s"] == None:
+    rate = "n/a"
+  else:
+    rate = "%.1f" % result["rows_per_s"]
+  print("%-20s %9d %-40s %9d %9.2f %11s %9.1f" % (
+    result["command"], result["events"], result["importer"], result["rows"],
+    result["elapsed_s"], rate, result["max_rss_kib"] / 1024.0))
+
+if __name__ == '__main__':
+  main()
@@ -1,24 +1,98 @@
 #!/usr/bin/python3
 import argparse
-import codecs
+import collections
+import concurrent.futures
 from enum import Enum
+import errno
+import fcntl
 import filecmp
 import glob
 import hashlib
+import heapq
+import io
+import itertools
+import mmap
+import operator
 import os.path
 import re
+import shutil
 import sqlite3
 import subprocess
 import sys
 import time
 import uuid
 
+DEFAULT_HASH_CACHE_FILE = os.path.expanduser("~/.cache/sms_db_importer/sha256-index.db")
+DEFAULT_CHECKSUM_CACHE_FILE = os.path.expanduser("~/.cache/sms_db_importer/mms-checksum.db")
+DEFAULT_CONTACTS_INDEX_FILE = os.path.expanduser("~/.cache/sms_db_importer/contacts-index.db")
+
 VERBOSE = False
 NO_COMMIT = False
+BATCH_SIZE = 1000
+BULK = False
+SKIP_EXISTING = False
+COMMIT_EVERY = 0
+RESUME = False
+JOBS = 1
+PARSE_JOBS = 1
+CHECKSUM_CACHE_FILE = DEFAULT_CHECKSUM_CACHE_FILE
+HASH_CACHE_FILE = DEFAULT_HASH_CACHE_FILE
 REMOTE_MMS_PARTS_DIR = "/home/nemo/.local/share/commhistory/data"
 LOCAL_UID = "/org/freedesktop/Telepathy/Account/ring/tel/ril_0"
 
 LIST_TEXTS_MAX_MESSAGES = 30
+CONTACT_NUMBER_SUFFIX_DIGITS = 10
+EXPORT_STATE_EVENT_TYPES = {"sms": 2, "calls": 3, "mms": 6}
+IMPORT_CHECKPOINT_TABLE = "SmsDbImporterCheckpoint"
+EXPORT_FETCH_SIZE = 1000
+MMS_PARTS_FETCH_BATCH_SIZE = 100
+EXPORT_WRITE_BUFFER_BYTES = 1024 * 1024
+HASH_CHUNK_BYTES = 1024 * 1024
+COPY_CHUNK_BYTES = 16 * 1024 * 1024
+FICLONE = 0x40049409 #linux/fs.h _IOW(0x94, 9, int)
+CHECKSUM_CACHE_MAX_ENTRIES = 200000
+CSV_PARSE_RANGES_PER_JOB = 4
+
+CONTENT_TYPES_BY_EXT = { "txt":  "text/plain;charset=utf-8"
+                       , "jpg":  "image/jpeg"
+                       , "jpeg": "image/jpeg"
+                       , "png":  "image/png"
+                       , "gif":  "image/gif"
+                       , "wav":  "audio/wav"
+                       , "flac": "audio/flac"
+                       , "ogg":  "audio/ogg"
+                       , "mp3":  "audio/mpeg"
+                       , "mp2":  "audio/mpeg"
+                       , "m2a":  "audio/mpeg"
+                       , "mpga": "audio/mpeg"
+                       , "mp4":  "video/mp4"
+                       , "mkv":  "video/x-matroska"
+                       , "webm": "video/webm"
+                       , "mpg":  "video/mpeg"
+                       , "mpeg": "video/mpeg"
+                       , "m1v":  "video/mpeg"
+                       , "m2v":  "video/mpeg"
+                       , "avi":  "video/avi"
+                       , "3gp":  "video/3gpp"
+                       , "amr":  "audio/AMR"
+                       }
+MIME_TYPE_REGEX = re.compile(r'^[a-z0-9]+/[a-z0-9\-.]+$')
+MAGIC_SNIFF_BYTES = 512
+FILE_CMD_MAX_ARGS = 500
+CONTENT_TYPES_BY_SHA256 = {}
+REGEX_CACHE = {}
+GROUP_RESOLVERS = {}
+
+#session-only settings for --bulk, on a copy of DB_FILE that is discarded on failure
+BULK_IMPORT_PRAGMAS = [ ("journal_mode", "MEMORY")
+                      , ("synchronous",  "OFF")
+                      , ("cache_size",   "-65536")
+                      , ("temp_store",   "MEMORY")
+                      ]
+BULK_IMPORT_INDEX_TABLES = ["events", "eventproperties", "messageparts"]
+#per-row 'UPDATE Events SET has...=1' triggers, redundant when the importers set the flags
+#  dropped for --bulk, and recreated and checked with verifyEventFlags() afterwards
+BULK_IMPORT_DROPPED_TRIGGERS = ["eventproperties_flag_insert", "messageparts_flag_insert"]
 
 usage = """Export/Import SMS, call log, and MMS from commhistory database
 Usage:
@@ -31,6 +105,12 @@ Usage:
   {appName} export-from-db-mms DB_FILE MMS_MSG_DIR MMS_PARTS_DIR [OPTS]
     export MMS messages from DB_FILE to MMS_MSG_DIR, using att files in MMS_PARTS_DIR
 
+  {appName} export-all DB_FILE SMS_CSV_FILE CALL_CSV_FILE MMS_MSG_DIR MMS_PARTS_DIR [OPTS]
+    same as export-from-db-sms, export-from-db-calls and export-from-db-mms,
+      in a single ordered pass over the Events table of DB_FILE
+    --since-event-id and --state-file apply to all three,
+      with the state file tracking each type separately
+
   {appName} import-to-db-sms DB_FILE CSV_FILE [OPTS]
     insert SMS from CSV_FILE into DB_FILE
 
@@ -42,6 +122,7 @@ Usage:
 
   {appName} list-texts DB_FILE [CONTACTS_CSV]
     print the last {listTextsMax} sms and mms messages from DB_FILE
+    contact names from CONTACTS_CSV are matched on the last {contactSuffixDigits} digits of the number
 
   {appName} mms-hash SUBJECT BODY [ATT_FILE ATT_FILE ..]
     insert MMS from MMS_MSG_DIR into DB_FILE, and ensure att files in MMS_PARTS_DIR
@@ -51,12 +132,83 @@ Usage:
     --limit           only import LIMIT entries into DB_FILE
     --verbose         verbose output (slower)
     --no-commit       do not commit changes when inserting into DB_FILE
-""".format(appName=os.path.basename(__file__), listTextsMax=LIST_TEXTS_MAX_MESSAGES)
+    --batch-size      insert BATCH_SIZE rows per executemany() when inserting into DB_FILE
+                      (default is {batchSize})
+    --bulk            when inserting into DB_FILE, import into a copy of DB_FILE with
+                      fast/unsafe journal+sync settings and without secondary indexes,
+                      then rebuild the indexes and replace DB_FILE with the copy
+                      (DB_FILE is left untouched if the import fails)
+                      Events.hasExtraProperties/hasMessageParts are set in the Events insert,
+                      without the per-row flag triggers, which are recreated afterwards,
+                      and the flags are checked against EventProperties/MessageParts
+    --skip-existing   when inserting into DB_FILE, skip messages/calls that are already in it,
+                      matched on number+endTime+direction+body (or MMS checksum=mmsId)
+                      so a restore onto a partially-populated DB only inserts what is missing
+    --commit-every    when inserting into DB_FILE, commit after every COMMIT_EVERY messages/calls
+                      (rounded up to a multiple of BATCH_SIZE) instead of once at the end,
+                      and save the last committed date_millis for sms/calls/mms
+                      in the {checkpointTable} table of DB_FILE, in the same transaction
+    --resume          when inserting into DB_FILE, skip the messages/calls up to the
+                      date_millis saved in DB_FILE by an earlier
+                      (interrupted) import with --commit-every
+                      (a completed import removes its checkpoint, and the table once empty)
+    --since-event-id  when exporting from DB_FILE, export only events with Events.id greater
+                      than SINCE_EVENT_ID, and append to CSV_FILE instead of overwriting it
+    --state-file      when exporting from DB_FILE, read the last exported Events.id for
+                      sms/calls/mms from STATE_FILE, export only newer events (like
+                      --since-event-id), and save the new high-water mark to STATE_FILE
+                      (falls back to a full export if DB_FILE max Events.id goes backwards)
+    --hash-cache      sqlite file caching sha256 of MMS att files by path+size+mtime+inode,
+                      so unchanged files are not re-read by import-to-db-mms
+                      (default is {hashCache})
+    --no-hash-cache   do not read or write the --hash-cache file
+    --checksum-cache  sqlite file caching MMS checksums by subject+body+att file identity,
+                      so unchanged MMS are not re-read by export-from-db-mms/import-to-db-mms
+                      (keeps the {checksumCacheMax} most recently used, default is {checksumCache})
+    --no-checksum-cache
+                      do not read or write the --checksum-cache file
+    --jobs            hash MMS att files with JOBS worker threads
+                      (default is {jobs})
+    --parse-jobs      parse CSV_FILE of import-to-db-sms/import-to-db-calls with PARSE_JOBS
+                      worker processes, each parsing a range of lines
+                      (default is {parseJobs})
+    --contacts-index  sqlite file indexing the CONTACTS_CSV of list-texts by number suffix,
+                      rebuilt only when the CONTACTS_CSV path, size or mtime changes
+                      (default is {contactsIndex})
+    --no-contacts-index
+                      do not read or write the --contacts-index file
+""".format(appName=os.path.basename(__file__), listTextsMax=LIST_TEXTS_MAX_MESSAGES,
+  contactSuffixDigits=CONTACT_NUMBER_SUFFIX_DIGITS,
+  checkpointTable=IMPORT_CHECKPOINT_TABLE,
+  contactsIndex=DEFAULT_CONTACTS_INDEX_FILE,
+  batchSize=BATCH_SIZE,
+  hashCache=DEFAULT_HASH_CACHE_FILE,
+  checksumCache=DEFAULT_CHECKSUM_CACHE_FILE,
+  checksumCacheMax=CHECKSUM_CACHE_MAX_ENTRIES,
+  jobs=JOBS,
+  parseJobs=PARSE_JOBS)
 
 SMS_DIR = Enum('SMS_DIR', ['OUT', 'INC'])
 MMS_DIR = Enum('MMS_DIR', ['OUT', 'INC', 'NTF'])
 CALL_DIR = Enum('CALL_DIR', ['OUT', 'INC', 'MIS', 'REJ'])
 
+#Events.direction written for each direction by importSMSToDb/importCallsToDb/importMMSToDb
+SMS_DIR_EVENT_DIRECTIONS = {SMS_DIR.OUT: 2, SMS_DIR.INC: 1}
+MMS_DIR_EVENT_DIRECTIONS = {MMS_DIR.OUT: 2, MMS_DIR.INC: 1}
+CALL_DIR_EVENT_DIRECTIONS = {CALL_DIR.OUT: 2, CALL_DIR.INC: 1, CALL_DIR.MIS: 1, CALL_DIR.REJ: 1}
+
+EVENTS_INSERT_COLS = [ "id", "type", "startTime", "endTime", "direction"
+                     , "isDraft", "isRead", "isMissedCall", "isEmergencyCall", "status"
+                     , "bytesReceived", "localUid", "remoteUid", "parentId", "subject"
+                     , "freeText", "groupId", "messageToken", "lastModified", "vCardFileName"
+                     , "vCardLabel", "isDeleted", "reportDelivery", "validityPeriod"
+                     , "contentLocation", "messageParts", "headers", "readStatus"
+                     , "reportRead", "reportedReadRequested", "mmsId", "isAction"
+                     , "hasExtraProperties", "hasMessageParts"
+                     ]
+EVENT_PROPERTIES_INSERT_COLS = ["eventId", "key", "value"]
+GROUPS_INSERT_COLS = ["id", "localUid", "remoteUids", "type", "chatName", "lastModified"]
+
 MMS_ATT_FILENAME_PREFIX_REGEX = re.compile(''
    + r'^\d+_'
    + r'([0-9+]+-)*[0-9+]+_'
@@ -64,6 +216,40 @@ MMS_ATT_FILENAME_PREFIX_REGEX = re.compile(''
    + r'[0-9a-f]{32}_'
    )
 
+#compiled once, for regexMatch/regexSub/regexSplit in per-row/per-part loops
+DIGITS_REGEX = re.compile(r'^\d+$')
+NON_DIGIT_CHARS_REGEX = re.compile(r'\D')
+HAS_DIGIT_REGEX = re.compile(r'\d')
+NON_NUMBER_CHARS_REGEX = re.compile(r'[^+0-9]')
+USA_COUNTRY_CODE_NUMBER_REGEX = re.compile(r'^\+?1(\d{10})$')
+USA_NUMBER_REGEX = re.compile(r'^\d{10}$')
+CALL_DURATION_REGEX = re.compile(r'\s*(-?)\s*(\d+)h\s*(\d+)m\s*(\d+)s')
+REMOTE_MMS_PARTS_DIR_PREFIX_REGEX = re.compile('^' + re.escape(REMOTE_MMS_PARTS_DIR) + '/')
+MMS_PART_EVENT_ID_DIR_REGEX = re.compile(r'^(\d+)/')
+MMS_PART_MSG_DIR_REGEX = re.compile(r'^msg-\d+-\d+/')
+MMS_PART_MSG_DIR_MTIME_REGEX = re.compile(r'^.*/msg-(\d+)-\d+/')
+MMS_TO_HEADER_REGEX = re.compile(r'x-mms-to(?:\u001D)?([0-9\+\u001E]*)', re.IGNORECASE)
+MMS_TO_HEADER_SEP_REGEX = re.compile(r'[\+\u001E]+')
+MMS_INFO_BLANK_LINE_REGEX = re.compile(r'^\s*$')
+MMS_INFO_LINE_REGEX = re.compile(
+  r'^(from|to|dir|date|date_sent|subject|body|att|checksum)=(.*)$')
+SMS_CSV_ROW_REGEX = re.compile(''
+  + r'([0-9+]*),'
+  + r'(\d+),'
+  + r'(\d+),'
+  + r'(S|M),'
+  + r'(' + '|'.join(sorted(SMS_DIR.__members__.keys())) + r'),'
+  + r'([^,]*),'
+  + r'\"(.*)\"'
+  )
+CALL_CSV_ROW_REGEX = re.compile(''
+  + r'([0-9+]+),'
+  + r'(\d+),'
+  + r'(' + '|'.join(sorted(CALL_DIR.__members__.keys())) + r'),'
+  + r'([^,]*),'
+  + r'(\s*-?\s*\d+h\s*\d+m\s*\d+s)'
+  )
+
 def addSubparser(subparsers, cmd, args):
   p = subparsers.add_parser(cmd)
   for arg in args:
@@ -76,6 +262,21 @@ def addOptArgs(parser):
   parser.add_argument('--verbose', '-v', action='store_true')
   parser.add_argument('--no-commit', '-n', action='store_true')
   parser.add_argument('--limit', type=int, default=0)
+  parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+  parser.add_argument('--bulk', action='store_true')
+  parser.add_argument('--skip-existing', action='store_true')
+  parser.add_argument('--commit-every', type=int, default=COMMIT_EVERY)
+  parser.add_argument('--resume', action='store_true')
+  parser.add_argument('--since-event-id', type=int)
+  parser.add_argument('--state-file')
+  parser.add_argument('--hash-cache', default=DEFAULT_HASH_CACHE_FILE)
+  parser.add_argument('--no-hash-cache', action='store_true')
+  parser.add_argument('--checksum-cache', default=DEFAULT_CHECKSUM_CACHE_FILE)
+  parser.add_argument('--no-checksum-cache', action='store_true')
+  parser.add_argument('--jobs', '-j', type=int, default=JOBS)
+  parser.add_argument('--parse-jobs', type=int, default=PARSE_JOBS)
+  parser.add_argument('--contacts-index', default=DEFAULT_CONTACTS_INDEX_FILE)
+  parser.add_argument('--no-contacts-index', action='store_true')
 
 class MyArgumentParser(argparse.ArgumentParser):
   def error(self, message):
@@ -89,6 +290,8 @@ def main():
   addSubparser(subparsers, 'export-from-db-sms', ['DB_FILE', 'CSV_FILE'])
   addSubparser(subparsers, 'export-from-db-calls', ['DB_FILE', 'CSV_FILE'])
   addSubparser(subparsers, 'export-from-db-mms', ['DB_FILE', 'MMS_MSG_DIR', 'MMS_PARTS_DIR'])
+  addSubparser(subparsers, 'export-all',
+    ['DB_FILE', 'SMS_CSV_FILE', 'CALL_CSV_FILE', 'MMS_MSG_DIR', 'MMS_PARTS_DIR'])
   addSubparser(subparsers, 'import-to-db-sms', ['DB_FILE', 'CSV_FILE'])
   addSubparser(subparsers, 'import-to-db-calls', ['DB_FILE', 'CSV_FILE'])
   addSubparser(subparsers, 'import-to-db-mms', ['DB_FILE', 'MMS_MSG_DIR', 'MMS_PARTS_DIR'])
@@ -98,10 +301,37 @@ def main():
   mmsHashSubParser.add_argument('ATT_FILE', nargs='*')
   args = parser.parse_args()
 
-  global VERBOSE, NO_COMMIT, MY_NUMBER
+  global VERBOSE, NO_COMMIT, MY_NUMBER, BATCH_SIZE, BULK, JOBS, CHECKSUM_CACHE_FILE
+  global HASH_CACHE_FILE, SKIP_EXISTING, COMMIT_EVERY, RESUME, PARSE_JOBS
   VERBOSE = args.verbose
   NO_COMMIT = args.no_commit
   MY_NUMBER = args.my_number
+  if args.batch_size < 1:
+    parser.error("--batch-size must be a positive integer")
+  BATCH_SIZE = args.batch_size
+  BULK = args.bulk
+  SKIP_EXISTING = args.skip_existing
+  if args.commit_every < 0:
+    parser.error("--commit-every must be a non-negative integer")
+  COMMIT_EVERY = args.commit_every
+  RESUME = args.resume
+  if BULK and (COMMIT_EVERY > 0 or RESUME):
+    #--bulk imports into a temporary copy, so there is nothing to resume after a crash
+    parser.error("--commit-every and --resume cannot be used with --bulk")
+  if args.jobs < 1:
+    parser.error("--jobs must be a positive integer")
+  JOBS = args.jobs
+  if args.parse_jobs < 1:
+    parser.error("--parse-jobs must be a positive integer")
+  PARSE_JOBS = args.parse_jobs
+  if args.no_checksum_cache:
+    CHECKSUM_CACHE_FILE = None
+  else:
+    CHECKSUM_CACHE_FILE = args.checksum_cache
+  if args.no_hash_cache:
+    HASH_CACHE_FILE = None
+  else:
+    HASH_CACHE_FILE = args.hash_cache
 
   if args.COMMAND == "mms-hash":
     subject = args.SUBJECT
@@ -126,19 +356,19 @@ def main():
     quit(1)
 
   if args.COMMAND == "export-from-db-sms":
-    texts = readTextsFromCommHistory(args.DB_FILE)
-    print("read " + str(len(texts)) + " SMS messages from " + args.DB_FILE)
-    f = codecs.open(args.CSV_FILE, 'w', 'utf-8')
-    for txt in texts:
-      f.write(txt.toCsv() + "\n")
-    f.close()
+    (sinceEventId, highWaterMark) = startIncrementalExport(args, "sms")
+    count = writeCsv(args.CSV_FILE,
+      iterTextsFromCommHistory(args.DB_FILE, sinceEventId, maxEventId=highWaterMark),
+      append=sinceEventId > 0)
+    print("read " + str(count) + " SMS messages from " + args.DB_FILE)
+    finishIncrementalExport(args, "sms", highWaterMark)
   elif args.COMMAND == "export-from-db-calls":
-    calls = readCallsFromCommHistory(args.DB_FILE)
-    print("read " + str(len(calls)) + " calls from " + args.DB_FILE)
-    f = codecs.open(args.CSV_FILE, 'w', 'utf-8')
-    for call in calls:
-      f.write(call.toCsv() + "\n")
-    f.close()
+    (sinceEventId, highWaterMark) = startIncrementalExport(args, "calls")
+    count = writeCsv(args.CSV_FILE,
+      iterCallsFromCommHistory(args.DB_FILE, sinceEventId, maxEventId=highWaterMark),
+      append=sinceEventId > 0)
+    print("read " + str(count) + " calls from " + args.DB_FILE)
+    finishIncrementalExport(args, "calls", highWaterMark)
   elif args.COMMAND == "export-from-db-mms":
     if not os.path.isdir(args.MMS_MSG_DIR):
       print("ERROR: no <MMS_MSG_DIR> for writing to")
@@ -146,82 +376,51 @@ def main():
     elif not os.path.isdir(args.MMS_PARTS_DIR):
       print("ERROR: no <MMS_PARTS_DIR> to read attachments from")
       quit(1)
-    mmsMessages = readMMSFromCommHistory(args.DB_FILE, args.MMS_PARTS_DIR)
+    (sinceEventId, highWaterMark) = startIncrementalExport(args, "mms")
+    mmsMessages = readMMSFromCommHistory(args.DB_FILE, args.MMS_PARTS_DIR,
+      sinceEventId=sinceEventId, maxEventId=highWaterMark)
     print("read " + str(len(mmsMessages)) + " MMS messages from " + args.DB_FILE)
-    attFileCount = 0
-    for msg in mmsMessages:
-      dirName = msg.getMsgDirName()
-      msgDir = args.MMS_MSG_DIR + "/" + dirName
-      if not os.path.isdir(msgDir):
-        os.mkdir(msgDir)
-
-      infoFilePath = msgDir + "/" + "info"
-
-      if os.path.isfile(infoFilePath):
-        msg.mergeExistingToNumbersFromInfo(infoFilePath)
-
-      infoFile = codecs.open(infoFilePath, 'w', 'utf-8')
-      infoFile.write(msg.getInfo())
-      infoFile.close()
-      for attName in sorted(msg.attFiles.keys()):
-        srcFile = msg.attFiles[attName]
-        destFile = msgDir + "/" + attName
-        if 0 != os.system("cp -ar --reflink=auto '" + srcFile + "' '" + destFile + "'"):
-          print("failed to copy " + str(srcFile))
-          quit(1)
-        attFileCount += 1
-
-      dtmFracS = "{fracS:.3f}".format(fracS=msg.date_millis/1000.0)
-      os.system("touch '" + msgDir + "' --date=@'" + dtmFracS + "'")
-      os.system("touch '" + infoFilePath + "' --date=@'" + dtmFracS + "'")
-
-    print("copied " + str(attFileCount) + " files from " + args.MMS_PARTS_DIR)
+    writeMMSMsgDirs(mmsMessages, args.MMS_MSG_DIR, args.MMS_PARTS_DIR)
+    finishIncrementalExport(args, "mms", highWaterMark)
+  elif args.COMMAND == "export-all":
+    if not os.path.isdir(args.MMS_MSG_DIR):
+      print("ERROR: no <MMS_MSG_DIR> for writing to")
+      quit(1)
+    elif not os.path.isdir(args.MMS_PARTS_DIR):
+      print("ERROR: no <MMS_PARTS_DIR> to read attachments from")
+      quit(1)
+    sinceEventIds = {}
+    highWaterMarks = {}
+    for stateKey in ["sms", "calls", "mms"]:
+      (sinceEventIds[stateKey], highWaterMarks[stateKey]) = startIncrementalExport(args, stateKey)
+    (smsCount, callCount, mmsMessages) = exportAllFromCommHistory(args.DB_FILE,
+      args.SMS_CSV_FILE, args.CALL_CSV_FILE, args.MMS_PARTS_DIR, sinceEventIds, highWaterMarks)
+    print("read " + str(smsCount) + " SMS messages from " + args.DB_FILE)
+    print("read " + str(callCount) + " calls from " + args.DB_FILE)
+    print("read " + str(len(mmsMessages)) + " MMS messages from " + args.DB_FILE)
+    writeMMSMsgDirs(mmsMessages, args.MMS_MSG_DIR, args.MMS_PARTS_DIR)
+    for stateKey in ["sms", "calls", "mms"]:
+      finishIncrementalExport(args, stateKey, highWaterMarks[stateKey])
   elif args.COMMAND == "import-to-db-sms":
     print("Reading texts from CSV file:")
     starttime = time.time()
     texts = readTextsFromCSV(args.CSV_FILE)
     print("finished in {0} seconds, {1} texts read".format( (time.time()-starttime), len(texts) ))
 
-    ignoredMissingNumberCount = 0
-    ignoredMMSToSMSCount = 0
-    okMessages = []
-    for txt in texts:
-      if txt.number == None or len(txt.number) == 0:
-        ignoredMissingNumberCount += 1
-      elif txt.sms_mms_type == "M":
-        ignoredMMSToSMSCount += 1
-      else:
-        okMessages.append(txt)
-    texts = okMessages
-
-    print("ignoring:")
-    print(" %5d SMS missing number" % ignoredMissingNumberCount)
-    print(" %5d MMS-to-SMS messages\n" % ignoredMMSToSMSCount)
-
-    print("sorting all {0} texts by date".format(len(texts)))
-    texts = sorted(texts, key=lambda text: text.date_millis)
-
-    if args.limit > 0:
-      print("saving only the last {0} texts".format(args.limit))
-      texts = texts[ (-args.limit) : ]
+    texts = prepareTextsForImport(texts, args.limit)
 
     print("Saving SMS into commhistory db:" + str(args.DB_FILE))
-    importSMSToDb(texts, args.DB_FILE)
+    runDbImport(importSMSToDb, texts, args.DB_FILE)
   elif args.COMMAND == "import-to-db-calls":
     print("Reading calls from CSV file:")
     starttime = time.time()
     calls = readCallsFromCSV(args.CSV_FILE)
     print("finished in {0} seconds, {1} calls read".format( (time.time()-starttime), len(calls) ))
 
-    print("sorting all {0} calls by date".format(len(calls)))
-    calls = sorted(calls, key=lambda call: call.date_millis)
-
-    if args.limit > 0:
-      print("saving only the last {0} calls".format(args.limit))
-      calls = calls[ (-args.limit) : ]
+    calls = prepareCallsForImport(calls, args.limit)
 
     print("Saving calls into commhistory db:" + str(args.DB_FILE))
-    importCallsToDb(calls, args.DB_FILE)
+    runDbImport(importCallsToDb, calls, args.DB_FILE)
   elif args.COMMAND == "import-to-db-mms":
     if not os.path.isdir(args.MMS_MSG_DIR):
       print("invalid MMS_MSG_DIR: " + args.MMS_MSG_DIR)
@@ -232,33 +431,7 @@ def main():
     print("reading mms from " + args.MMS_MSG_DIR)
     mmsMessages = readMMSFromMsgDir(args.MMS_MSG_DIR, args.MMS_PARTS_DIR)
 
-    ignoredNTFCount = 0
-    ignoredGroupCount = 0
-    ignoredMissingToCount = 0
-    ignoredMissingFromCount = 0
-    okMessages = []
-    for mms in mmsMessages:
-      if mms.direction == MMS_DIR.NTF:
-        ignoredNTFCount += 1
-      elif len(mms.to_numbers) < 1:
-        ignoredMissingToCount += 1
-      elif mms.from_number == None or mms.from_number == "":
-        ignoredMissingFromCount += 1
-      else:
-        okMessages.append(mms)
-    mmsMessages = okMessages
-
-    print("ignoring:")
-    print(" %5d NTF MMS" % ignoredNTFCount)
-    print(" %5d MMS missing 'to' number\n" % ignoredMissingToCount)
-    print(" %5d MMS missing 'from' number\n" % ignoredMissingFromCount)
-
-    print("sorting all {0} MMS messages by date".format(len(mmsMessages)))
-    mmsMessages = sorted(mmsMessages, key=lambda mms: mms.date_millis)
-
-    if args.limit > 0:
-      print("saving only the last {0} MMS messages".format(args.limit))
-      mmsMessages = mmsMessages[ (-args.limit) : ]
+    mmsMessages = prepareMMSForImport(mmsMessages, args.limit)
 
     print("checking MMS message consistency\n")
     for mms in mmsMessages:
@@ -268,31 +441,38 @@ def main():
         print("error reading MMS(" + str(msgDir) + ":\n" + str(mms))
         quit(1)
 
-      oldChecksum = mms.checksum
-      mms.generateChecksum()
-      newChecksum = mms.checksum
-
-      if oldChecksum != newChecksum:
+    newChecksums = generateMMSChecksums(mmsMessages)
+    for (mms, newChecksum) in zip(mmsMessages, newChecksums):
+      if mms.checksum != newChecksum:
         print("mismatched checksum for MMS message\n" + str(mms))
         quit(1)
 
+    hashIndex = FileHashIndex(HASH_CACHE_FILE)
+
     print("getting sha256 checksums of all att files in parts dir")
-    partsDirFilesBySHA256ByFilename = {}
+    partsDirFiles = []
     for root, dirnames, filenames in os.walk(args.MMS_PARTS_DIR):
       if ".git" not in root:
         for filename in filenames:
-          f = os.path.join(root, filename)
-          sha256 = hashlib.sha256(open(f, 'rb').read()).hexdigest()
-          if sha256 not in partsDirFilesBySHA256ByFilename:
-            partsDirFilesBySHA256ByFilename[sha256] = {}
-          unprefixedFilename = MMS_ATT_FILENAME_PREFIX_REGEX.sub('', filename)
-          partsDirFilesBySHA256ByFilename[sha256][unprefixedFilename] = f
+          partsDirFiles.append((filename, os.path.join(root, filename)))
+    partsDirSHA256s = hashIndex.sha256Files([f for (filename, f) in partsDirFiles])
+
+    partsDirFilesBySHA256ByFilename = {}
+    for ((filename, f), sha256) in zip(partsDirFiles, partsDirSHA256s):
+      if sha256 not in partsDirFilesBySHA256ByFilename:
+        partsDirFilesBySHA256ByFilename[sha256] = {}
+      unprefixedFilename = MMS_ATT_FILENAME_PREFIX_REGEX.sub('', filename)
+      partsDirFilesBySHA256ByFilename[sha256][unprefixedFilename] = f
 
     print("matching up att files from msg dir against parts dir by checksum")
+    localPartsDirPrefixRegex = re.compile('^' + args.MMS_PARTS_DIR + '/?')
+    msgDirSHA256s = hashIndex.sha256Files([mms.attFiles[filename]
+                                           for mms in mmsMessages
+                                           for filename in sorted(mms.attFiles.keys())])
+    msgDirSHA256s.reverse()
     for mms in mmsMessages:
       for filename in sorted(list(mms.attFiles.keys())):
-        srcFile = mms.attFiles[filename]
-        sha256 = hashlib.sha256(open(srcFile, 'rb').read()).hexdigest()
+        sha256 = msgDirSHA256s.pop()
 
         if sha256 not in partsDirFilesBySHA256ByFilename:
           print("ERROR: att missing from parts dir for mms\n" + str(mms))
@@ -303,58 +483,68 @@ def main():
           quit(1)
 
         destFile = sha256Files[filename]
-        remoteFile = regexSub('^' + args.MMS_PARTS_DIR + '/?', REMOTE_MMS_PARTS_DIR + '/', destFile)
+        remoteFile = regexSub(localPartsDirPrefixRegex, REMOTE_MMS_PARTS_DIR + '/', destFile)
 
         mms.attFiles[filename] = destFile
         mms.attFilesRemotePaths[filename] = remoteFile
     print("read " + str(len(mmsMessages)) + " MMS messages")
+    print(hashIndex.formatStats())
+    hashIndex.close()
 
     print("Saving MMS into commhistory db:" + str(args.DB_FILE))
-    importMMSToDb(mmsMessages, args.DB_FILE)
+    runDbImport(importMMSToDb, mmsMessages, args.DB_FILE)
   elif args.COMMAND == "list-texts":
-    texts = readTextsFromCommHistory(args.DB_FILE)
-    print("read " + str(len(texts)) + " SMS messages from " + args.DB_FILE)
+    #only read the events that can be in the last LIST_TEXTS_MAX_MESSAGES of each type
+    smsMinEndTime = getRecentMinEndTime(args.DB_FILE, 2, LIST_TEXTS_MAX_MESSAGES)
+    texts = list(iterTextsFromCommHistory(args.DB_FILE, minEndTime=smsMinEndTime))
+    print("read " + str(len(texts)) + " recent SMS messages from " + args.DB_FILE)
 
-    mmsMessages = readMMSFromCommHistory(args.DB_FILE, "/FAKE_MMS_PARTS_DIR", skipChecksums=True)
-    print("read " + str(len(mmsMessages)) + " MMS messages from " + args.DB_FILE)
+    mmsMinEndTime = getRecentMinEndTime(args.DB_FILE, 6, LIST_TEXTS_MAX_MESSAGES)
+    mmsPartsReader = MMSPartsReader(args.DB_FILE, skipChecksums=True)
+    mmsMessages = readMMSFromCommHistory(args.DB_FILE, "/FAKE_MMS_PARTS_DIR",
+      skipChecksums=True, minEndTime=mmsMinEndTime, partsReader=mmsPartsReader)
+    print("read " + str(len(mmsMessages)) + " recent MMS messages from " + args.DB_FILE)
 
     print("\n")
 
+    contactIndex = None
     if args.CONTACTS_CSV != None:
-      contacts = readContactsCSV(args.CONTACTS_CSV)
-    else:
-      contacts = dict()
-
-    recentMessages = []
-    for msg in texts:
-      recentMessages.append({ 'date_millis': msg.date_millis
-                            , 'date_format': msg.date_format
-                            , 'number': msg.number
-                            , 'body': msg.formatPretty()
-                            , 'dir_format': msg.getDirectionStr()
-                            })
-
-    for msg in mmsMessages:
-      recentMessages.append({ 'date_millis': msg.date_millis
-                            , 'date_format': msg.date_format
-                            , 'number': msg.getMainNumber()
-                            , 'body': msg.formatPretty()
-                            , 'dir_format': msg.getDirectionStr()
-                            })
-
-    recentMessages = sorted(
-      recentMessages,
+      if args.no_contacts_index:
+        contactIndex = ContactIndex(None, args.CONTACTS_CSV)
+      else:
+        contactIndex = ContactIndex(args.contacts_index, args.CONTACTS_CSV)
+
+    #newest first, ties in Events.id order, SMS before MMS
+    texts = sorted(texts, key=lambda msg: msg.date_millis, reverse=True)
+    mmsMessages = sorted(mmsMessages, key=lambda msg: msg.date_millis, reverse=True)
+
+    recentTexts = ({ 'date_millis': msg.date_millis
+                   , 'date_format': msg.date_format
+                   , 'number': msg.number
+                   , 'body': msg.formatPretty()
+                   , 'dir_format': msg.getDirectionStr()
+                   } for msg in texts)
+
+    recentMMS = ({ 'date_millis': msg.date_millis
+                 , 'date_format': msg.date_format
+                 , 'number': msg.getMainNumber()
+                 , 'body': msg.formatPretty()
+                 , 'dir_format': msg.getDirectionStr()
+                 } for msg in mmsMessages)
+
+    recentMessages = heapq.merge(recentTexts, recentMMS,
       key=lambda msg: msg['date_millis'],
       reverse=True)
 
-    recentMessages = recentMessages[0 : LIST_TEXTS_MAX_MESSAGES]
+    recentMessages = list(itertools.islice(recentMessages, LIST_TEXTS_MAX_MESSAGES))
     recentMessages.reverse()
 
     for msg in recentMessages:
       number = cleanNumber(msg['number'])
-      if number in contacts:
-        contact = contacts[number]
-      else:
+      contact = None
+      if contactIndex != None:
+        contact = contactIndex.lookup(number)
+      if contact == None:
         contact = ""
       print("%s %s %s (%s) %s" % (
          msg['date_format'],
@@ -363,10 +553,61 @@ def main():
          contact,
          msg['body']))
 
+    mmsPartsReader.close()
+    if contactIndex != None:
+      contactIndex.close()
   else:
     print("invalid <COMMAND>: " + args.COMMAND)
     quit(1)
 
+#like `cp -a --reflink=auto`, without forking:
+#  clone with FICLONE if the fs supports it, else os.copy_file_range(), else read+write
+#  then copy mode+atime+mtime (ns)
+#returns False and does nothing if destFile already has the same size and mtime
+def copyFilePreserve(srcFile, destFile):
+  if os.path.islink(srcFile):
+    if os.path.lexists(destFile):
+      os.remove(destFile)
+    os.symlink(os.readlink(srcFile), destFile)
+    return True
+
+  srcStat = os.stat(srcFile)
+  if os.path.isfile(destFile) and not os.path.islink(destFile):
+    destStat = os.stat(destFile)
+    if destStat.st_size == srcStat.st_size and destStat.st_mtime_ns == srcStat.st_mtime_ns:
+      return False
+
+  with open(srcFile, 'rb') as src, open(destFile, 'wb') as dest:
+    if not cloneFileContents(src, dest, srcStat.st_size):
+      shutil.copyfileobj(src, dest, COPY_CHUNK_BYTES)
+  shutil.copystat(srcFile, destFile)
+  return True
+
+#returns False, having written nothing, if neither FICLONE nor copy_file_range work here
+def cloneFileContents(src, dest, size):
+  try:
+    fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+    return True
+  except OSError:
+    pass
+
+  if not hasattr(os, "copy_file_range"):
+    return False
+  offset = 0
+  while offset < size:
+    try:
+      copied = os.copy_file_range(src.fileno(), dest.fileno(), COPY_CHUNK_BYTES,
+        offset, offset)
+    except OSError as e:
+      if offset == 0 and e.errno in [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                     errno.EOPNOTSUPP, errno.EPERM]:
+        return False
+      raise
+    if copied == 0:
+      break
+    offset += copied
+  return True
+
 def md5Update(md5, msg):
   if type(msg) == str:
     md5.update(msg.encode("utf-8"))
@@ -385,12 +626,190 @@ def generateMMSChecksum(subject, body, attFiles):
     if not os.path.isfile(filepath):
       print("missing att file: " + filepath)
       return None
-    f = open(filepath, 'rb')
-    md5Update(md5, f.read())
-    f.close()
+    with open(filepath, 'rb') as f:
+      for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+        md5Update(md5, chunk)
   return md5.hexdigest()
 
+#MMS.generateChecksum() for each MMS, spread over JOBS threads
+#  each checksum is still a single md5 fed in sorted attName order
+#  checksums are looked up in, and saved to, CHECKSUM_CACHE_FILE
+def generateMMSChecksums(mmsMessages):
+  mmsMessages = list(mmsMessages)
+  checksumCache = MMSChecksumCache(CHECKSUM_CACHE_FILE)
+
+  checksums = [None] * len(mmsMessages)
+  cacheKeys = [None] * len(mmsMessages)
+  misses = []
+  for i in range(len(mmsMessages)):
+    cacheKeys[i] = checksumCache.getKey(mmsMessages[i])
+    checksums[i] = checksumCache.get(cacheKeys[i])
+    if checksums[i] == None:
+      misses.append(i)
+
+  startTime = time.time()
+  missChecksums = parallelMap(lambda i: mmsMessages[i].generateChecksum(), misses)
+  elapsedS = time.time() - startTime
+
+  for (i, checksum) in zip(misses, missChecksums):
+    checksums[i] = checksum
+    checksumCache.put(cacheKeys[i], checksum)
+  checksumCache.close()
+
+  attFiles = [f for i in misses for f in mmsMessages[i].attFiles.values()]
+  byteCount = sum([os.path.getsize(f) for f in attFiles])
+  print(formatHashThroughput("md5", len(attFiles), byteCount, elapsedS)
+    + ", " + str(len(mmsMessages) - len(misses)) + " MMS cached")
+  return checksums
+
+#same as list(map(fct, items)), in order, using JOBS threads
+#  (hashlib releases the GIL while hashing large buffers)
+def parallelMap(fct, items):
+  if JOBS <= 1 or len(items) <= 1:
+    return list(map(fct, items))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=JOBS) as pool:
+    return list(pool.map(fct, items))
+
+def formatHashThroughput(hashName, fileCount, byteCount, elapsedS):
+  mib = byteCount / 1024.0 / 1024.0
+  mibPerSec = mib / elapsedS if elapsedS > 0 else 0
+  return "{0}: hashed {1} files, {2:.1f}MiB in {3:.2f}s @ {4:.1f}MiB/s ({5} jobs)".format(
+    hashName, fileCount, mib, elapsedS, mibPerSec, JOBS)
+
+def sha256File(filepath):
+  sha256 = hashlib.sha256()
+  with open(filepath, 'rb') as f:
+    for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+      sha256.update(chunk)
+  return sha256.hexdigest()
+
+def openCacheDb(cacheFile, createTableSql):
+  cacheDir = os.path.dirname(os.path.abspath(cacheFile))
+  if not os.path.isdir(cacheDir):
+    os.makedirs(cacheDir)
+  conn = sqlite3.connect(cacheFile)
+  conn.execute(createTableSql)
+  return conn
+
+#MMS checksums keyed on subject, body and the identity of each att file,
+#  which never change for an MMS without changing its checksum
+#  least recently used entries past CHECKSUM_CACHE_MAX_ENTRIES are dropped on close()
+#  cacheFile=None keeps nothing, and get() always misses
+class MMSChecksumCache:
+  def __init__(self, cacheFile):
+    self.conn = None
+    self.usedKeys = []
+    if cacheFile != None:
+      self.conn = openCacheDb(cacheFile, ""
+        + " CREATE TABLE IF NOT EXISTS mms_checksum ("
+        + "   key TEXT PRIMARY KEY,"
+        + "   checksum TEXT,"
+        + "   last_used INTEGER"
+        + " );")
+  #None if any att file is missing
+  def getKey(self, mms):
+    key = hashlib.sha256()
+    md5Update(key, repr(mms.subject) + "\n" + repr(mms.body) + "\n")
+    for attName in sorted(mms.attFiles.keys()):
+      try:
+        st = os.stat(mms.attFiles[attName])
+      except OSError:
+        return None
+      md5Update(key, repr((attName, st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino)) + "\n")
+    return key.hexdigest()
+  def get(self, key):
+    if self.conn == None or key == None:
+      return None
+    row = self.conn.execute(
+      "SELECT checksum FROM mms_checksum WHERE key = ?;", (key,)).fetchone()
+    if row == None:
+      return None
+    self.usedKeys.append(key)
+    return row[0]
+  def put(self, key, checksum):
+    if self.conn == None or key == None or checksum == None:
+      return
+    self.conn.execute("INSERT OR REPLACE INTO mms_checksum VALUES (?, ?, 0);",
+      (key, checksum))
+    self.usedKeys.append(key)
+  def close(self):
+    if self.conn == None:
+      return
+    nowMillis = int(time.time() * 1000)
+    self.conn.executemany("UPDATE mms_checksum SET last_used = ? WHERE key = ?;",
+      [(nowMillis, key) for key in self.usedKeys])
+    self.conn.execute(""
+      + " DELETE FROM mms_checksum"
+      + " WHERE key NOT IN ("
+      + "   SELECT key FROM mms_checksum ORDER BY last_used DESC LIMIT ?"
+      + " );", (CHECKSUM_CACHE_MAX_ENTRIES,))
+    self.conn.commit()
+    self.conn.close()
+    self.conn = None
+
+#persistent sha256 of files, keyed on path and invalidated when size/mtime/inode change
+#  cacheFile=None keeps nothing on disk, and just hashes every file
+class FileHashIndex:
+  def __init__(self, cacheFile):
+    self.conn = None
+    self.hitCount = 0
+    self.missCount = 0
+    self.missBytes = 0
+    self.hashSeconds = 0
+    if cacheFile != None:
+      self.conn = openCacheDb(cacheFile, ""
+        + " CREATE TABLE IF NOT EXISTS file_sha256 ("
+        + "   path TEXT PRIMARY KEY,"
+        + "   size INTEGER,"
+        + "   mtime_ns INTEGER,"
+        + "   inode INTEGER,"
+        + "   sha256 TEXT"
+        + " );")
+  def sha256(self, filepath):
+    return self.sha256Files([filepath])[0]
+  #cache lookups+writes happen in this thread, uncached files are hashed with parallelMap()
+  def sha256Files(self, filepaths):
+    sha256s = [None] * len(filepaths)
+    misses = []
+    for i in range(len(filepaths)):
+      path = os.path.abspath(filepaths[i])
+      st = os.stat(path)
+      if self.conn != None:
+        row = self.conn.execute(
+          "SELECT size, mtime_ns, inode, sha256 FROM file_sha256 WHERE path = ?;",
+          (path,)).fetchone()
+        if row != None and tuple(row[0:3]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+          self.hitCount += 1
+          sha256s[i] = row[3]
+          continue
+      misses.append((i, path, st))
+
+    startTime = time.time()
+    missSHA256s = parallelMap(lambda miss: sha256File(miss[1]), misses)
+    elapsedS = time.time() - startTime
+    self.hashSeconds += elapsedS
+
+    for ((i, path, st), sha256) in zip(misses, missSHA256s):
+      sha256s[i] = sha256
+      self.missCount += 1
+      self.missBytes += st.st_size
+      if self.conn != None:
+        self.conn.execute(
+          "INSERT OR REPLACE INTO file_sha256 VALUES (?, ?, ?, ?, ?);",
+          (path, st.st_size, st.st_mtime_ns, st.st_ino, sha256))
+    return sha256s
+  def formatStats(self):
+    return (formatHashThroughput("sha256", self.missCount, self.missBytes, self.hashSeconds)
+      + ", " + str(self.hitCount) + " cached")
+  def close(self):
+    if self.conn != None:
+      self.conn.commit()
+      self.conn.close()
+      self.conn = None
+
 class Text:
+  __slots__ = ('number', 'date_millis', 'date_sent_millis',
+               'sms_mms_type', 'direction', 'date_format', 'body')
   def __init__(self, number, date_millis, date_sent_millis,
                sms_mms_type, direction, date_format, body):
     self.number = number
@@ -435,6 +854,7 @@ class Text:
     return self.toCsv()
 
 class Call:
+  __slots__ = ('number', 'date_millis', 'direction', 'date_format', 'duration_format')
   def __init__(self, number, date_millis, direction, date_format, duration_format):
     self.number = number
     self.date_millis = date_millis
@@ -444,8 +864,7 @@ class Call:
   def cleanNumber(self):
     self.number = cleanNumber(self.number)
   def getDurationSex(self):
-    durationRegex = re.compile(r'\s*(-?)\s*(\d+)h\s*(\d+)m\s*(\d+)s')
-    m = durationRegex.match(self.duration_format)
+    m = CALL_DURATION_REGEX.match(self.duration_format)
     if not m or len(m.groups()) != 4:
       print("invalid duration format: " + self.duration_format)
       quit(1)
@@ -505,6 +924,10 @@ def unescapeStr(s):
   )
 
 class MMS:
+  __slots__ = ('mms_parts_dir', 'from_number', 'to_numbers',
+               'date_millis', 'date_sent_millis', 'direction', 'date_format',
+               'subject', 'body',
+               '_parts', '_attFiles', '_attFilesRemotePaths', '_checksum', '_partsLoader')
   def __init__(self, mms_parts_dir):
     self.mms_parts_dir = mms_parts_dir
     self.from_number = None
@@ -516,10 +939,67 @@ class MMS:
     self.subject = None
     self.body = None
 
-    self.parts = []
-    self.attFiles = {}
-    self.attFilesRemotePaths = {}
-    self.checksum = None
+    #parts, attFiles and attFilesRemotePaths are allocated on first access
+    self._parts = None
+    self._attFiles = None
+    self._attFilesRemotePaths = None
+    self._checksum = None
+
+    #(MMSPartsReader, event_id) until the parts are fetched, see setPartsLoader()
+    self._partsLoader = None
+  @property
+  def parts(self):
+    self.resolveParts()
+    if self._parts == None:
+      self._parts = []
+    return self._parts
+  @parts.setter
+  def parts(self, parts):
+    self.resolveParts()
+    self._parts = parts
+  @property
+  def attFiles(self):
+    self.resolveParts()
+    if self._attFiles == None:
+      self._attFiles = {}
+    return self._attFiles
+  @attFiles.setter
+  def attFiles(self, attFiles):
+    self.resolveParts()
+    self._attFiles = attFiles
+  @property
+  def attFilesRemotePaths(self):
+    self.resolveParts()
+    if self._attFilesRemotePaths == None:
+      self._attFilesRemotePaths = {}
+    return self._attFilesRemotePaths
+  @attFilesRemotePaths.setter
+  def attFilesRemotePaths(self, attFilesRemotePaths):
+    self.resolveParts()
+    self._attFilesRemotePaths = attFilesRemotePaths
+  @property
+  def checksum(self):
+    self.resolveParts()
+    return self._checksum
+  @checksum.setter
+  def checksum(self, checksum):
+    self.resolveParts()
+    self._checksum = checksum
+  #fetch the parts of Events.id=event_id from partsReader on first access of
+  #  parts, attFiles, attFilesRemotePaths or checksum, and parseParts() them
+  def setPartsLoader(self, partsReader, event_id):
+    self._partsLoader = (partsReader, event_id)
+  def resolveParts(self):
+    if self._partsLoader != None:
+      (partsReader, event_id) = self._partsLoader
+      self._partsLoader = None
+      self._parts = partsReader.getParts(event_id)
+      self.parseParts(skipChecksum=partsReader.skipChecksums)
+  def getAttNames(self):
+    self.resolveParts()
+    if self._attFiles == None:
+      return []
+    return sorted(self._attFiles.keys())
   def cleanNumbers(self):
     self.from_number = cleanNumber(self.from_number)
     toNumbers = []
@@ -527,18 +1007,18 @@ class MMS:
       toNumbers.append(cleanNumber(toNumber))
     self.to_numbers = toNumbers
   def parseParts(self, skipChecksum=False):
-    self.attFiles = {}
-    self.attFilesRemotePaths = {}
+    self._attFiles = None
+    self._attFilesRemotePaths = None
     self.checksum = None
     for p in self.parts:
       if 'smil' in p.part_type:
         pass
       elif p.filepath != None:
         relFilepath = p.filepath
-        relFilepath = regexSub('^' + REMOTE_MMS_PARTS_DIR + '/', '', relFilepath)
+        relFilepath = regexSub(REMOTE_MMS_PARTS_DIR_PREFIX_REGEX, '', relFilepath)
         filename = relFilepath
-        filename = regexSub(r'^\d+/', '', filename)
-        filename = regexSub(r'^msg-\d+-\d+/', '', filename)
+        filename = regexSub(MMS_PART_EVENT_ID_DIR_REGEX, '', filename)
+        filename = regexSub(MMS_PART_MSG_DIR_REGEX, '', filename)
         if "/" in filename:
           print("filename contains path sep '/': " + filename)
           quit(1)
@@ -549,7 +1029,7 @@ class MMS:
         #attempt to find renamed event-id dirs
         if not os.path.isfile(localFilepath):
           newPartDirFiles = []
-          m = regexMatch(r'^(\d+)/', relFilepath)
+          m = regexMatch(MMS_PART_EVENT_ID_DIR_REGEX, relFilepath)
           if m:
             oldEventId = m.group(1)
             newPartDirFiles = glob.glob(
@@ -559,7 +1039,7 @@ class MMS:
           match = None
           for newPartDirFile in newPartDirFiles:
             mtimeMillis = None
-            m = regexMatch(r'^.*/msg-(\d+)-\d+/', newPartDirFile)
+            m = regexMatch(MMS_PART_MSG_DIR_MTIME_REGEX, newPartDirFile)
             if m:
               mtimeMillis = 1000 * int(m.group(1))
               diff = self.date_millis - mtimeMillis
@@ -615,7 +1095,7 @@ class MMS:
     info += "date_sent=" + str(date_sent_millis) + "\n"
     info += "subject=\"" + escapeStr(self.subject) + "\"\n"
     info += "body=\"" + escapeStr(self.body) + "\"\n"
-    for attName in sorted(self.attFiles.keys()):
+    for attName in self.getAttNames():
       info += "att=" + str(attName) + "\n"
     info += "checksum=" + str(self.checksum) + "\n"
     return info
@@ -629,9 +1109,9 @@ class MMS:
 
     infoDict = {}
     for line in lines:
-      if regexMatch(r'^\s*$', line):
+      if regexMatch(MMS_INFO_BLANK_LINE_REGEX, line):
         continue
-      m = regexMatch(r'^(from|to|dir|date|date_sent|subject|body|att|checksum)=(.*)$', line)
+      m = regexMatch(MMS_INFO_LINE_REGEX, line)
       if m:
         key = m.group(1)
         val = m.group(2)
@@ -667,7 +1147,7 @@ class MMS:
     else:
       fmt += self.body
     fmt += " (MMS)"
-    for attName in sorted(self.attFiles.keys()):
+    for attName in self.getAttNames():
       fmt += " |" + attName
     return fmt
   def isOutgoing(self):
@@ -688,212 +1168,570 @@ class MMS:
     return self.getInfo()
 
 class MMSPart:
-  def __init__(self):
-    self.part_type = None
-    self.filepath = None
+  __slots__ = ('part_type', 'filepath')
+  def __init__(self, part_type=None, filepath=None):
+    self.part_type = part_type
+    self.filepath = filepath
+
+#fetches the MessageParts of MMS read with a partsReader, on first access of each MMS
+#  the eventIds are fetched in batches of MMS_PARTS_FETCH_BATCH_SIZE, in Events.id order,
+#  with one indexed `eventId IN (...)` query per batch
+#  close() it once the MMS are no longer used
+class MMSPartsReader:
+  def __init__(self, db_file, skipChecksums):
+    self.db_file = db_file
+    self.conn = None
+    self.skipChecksums = skipChecksums
+    self.batchIndexByEventId = {}
+    self.batches = []
+    self.partsByEventId = {}
+  def addEventIds(self, eventIds):
+    eventIds = sorted(eventIds)
+    for i in range(0, len(eventIds), MMS_PARTS_FETCH_BATCH_SIZE):
+      batch = eventIds[i:i+MMS_PARTS_FETCH_BATCH_SIZE]
+      for event_id in batch:
+        self.batchIndexByEventId[event_id] = len(self.batches)
+      self.batches.append(batch)
+  def getParts(self, event_id):
+    if event_id not in self.partsByEventId:
+      self.fetchBatch(self.batches[self.batchIndexByEventId[event_id]])
+    return self.partsByEventId.pop(event_id)
+  def fetchBatch(self, batch):
+    if self.conn == None:
+      self.conn = sqlite3.connect(self.db_file)
+    for event_id in batch:
+      self.partsByEventId[event_id] = []
+    rows = self.conn.execute(
+      'SELECT eventId, contentType, path \
+       FROM messageParts \
+       WHERE eventId IN (' + ", ".join(["?"] * len(batch)) + ') \
+       ORDER BY id ASC;', batch)
+    for (event_id, part_type, filepath) in rows:
+      self.partsByEventId[event_id].append(MMSPart(part_type, filepath))
+  def close(self):
+    if self.conn != None:
+      self.conn.close()
+      self.conn = None
 
 def cleanNumber(number):
   if number == None:
     number = ''
-  number = regexSub(r'[^+0-9]', '', number)
-  number = regexSub(r'^\+?1(\d{10})$', '\\1', number)
+  number = regexSub(NON_NUMBER_CHARS_REGEX, '', number)
+  number = regexSub(USA_COUNTRY_CODE_NUMBER_REGEX, '\\1', number)
   return number
 
 def maybePrependUSANumber(number):
   if number == None:
     number = ''
-  if regexMatch(r'^\d{10}$', number):
+  if regexMatch(USA_NUMBER_REGEX, number):
     number = '+1' + number
   return number
 
-def readTextsFromCSV(csvFile):
+#match each line of csvFile against rowRegex, one line at a time
+#  quits with the line number of the first line that does not match
+def iterCSVMatches(csvFile, rowRegex, rowName):
   try:
-    csvFile = open(csvFile, 'r')
-    csvContents = csvFile.read()
-    csvFile.close()
+    f = open(csvFile, 'r')
   except IOError:
     print("could not read csv file: " + str(csvFile))
     quit(1)
 
-  texts = []
-  rowRegex = re.compile(''
-    + r'([0-9+]*),'
-    + r'(\d+),'
-    + r'(\d+),'
-    + r'(S|M),'
-    + r'(' + '|'.join(sorted(SMS_DIR.__members__.keys())) + r'),'
-    + r'([^,]*),'
-    + r'\"(.*)\"'
-    )
-  for row in csvContents.splitlines():
-    m = rowRegex.match(row)
-    if not m or len(m.groups()) != 7:
-      print("invalid SMS CSV line: " + row)
-      quit(1)
-    number           = m.group(1)
-    date_millis      = int(m.group(2))
-    date_sent_millis = int(m.group(3))
-    sms_mms_type     = m.group(4)
-    directionStr     = m.group(5)
-    date_format      = m.group(6)
-    body             = unescapeStr(m.group(7))
-
-    texts.append(Text( number
-                     , date_millis
-                     , date_sent_millis
-                     , sms_mms_type
-                     , SMS_DIR.__members__[directionStr]
-                     , date_format
-                     , body
-                     ))
-  return texts
+  with f:
+    for lineNum, row in enumerate(f, 1):
+      m = rowRegex.match(row.rstrip('\n'))
+      if not m:
+        print("{0}:{1}: invalid {2} CSV line".format(csvFile, lineNum, rowName))
+        quit(1)
+      yield m
+
+#recordClass(*parseMatchFct()) of each line of csvFile, in order
+#  with PARSE_JOBS > 1, ranges of lines are parsed in PARSE_JOBS worker processes
+#  workers return plain tuples of fields, which are much cheaper to pickle than records
+def iterCSVRecords(csvFile, rowRegex, rowName, parseMatchFct, recordClass):
+  if PARSE_JOBS <= 1:
+    for m in iterCSVMatches(csvFile, rowRegex, rowName):
+      yield recordClass(*parseMatchFct(m))
+    return
+
+  byteRanges = getCSVByteRanges(csvFile, PARSE_JOBS * CSV_PARSE_RANGES_PER_JOB)
+  lineNum = 0
+  with concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_JOBS) as pool:
+    futures = [pool.submit(parseCSVByteRange, csvFile, start, end, rowRegex, parseMatchFct)
+               for (start, end) in byteRanges]
+    for future in futures:
+      (rows, lineCount, isInvalid) = future.result()
+      yield from itertools.starmap(recordClass, rows)
+      lineNum += lineCount
+      if isInvalid:
+        for f in futures:
+          f.cancel()
+        print("{0}:{1}: invalid {2} CSV line".format(csvFile, lineNum, rowName))
+        quit(1)
+
+#split csvFile into at most rangeCount (start, end) byte offsets, ending just after a newline
+#  every line is in exactly one range, so ranges can be parsed independently
+def getCSVByteRanges(csvFile, rangeCount):
+  try:
+    f = open(csvFile, 'rb')
+  except IOError:
+    print("could not read csv file: " + str(csvFile))
+    quit(1)
+
+  with f:
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return []
+    byteRanges = []
+    start = 0
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      for i in range(1, rangeCount):
+        newlinePos = mm.find(b'\n', max(start, size * i // rangeCount))
+        if newlinePos < 0:
+          break
+        byteRanges.append((start, newlinePos + 1))
+        start = newlinePos + 1
+    if start < size:
+      byteRanges.append((start, size))
+    return byteRanges
+
+#worker for iterCSVRecords(), parses the lines of csvFile between byte offsets start and end
+#  decodes and splits lines the same way as open(csvFile, 'r') in iterCSVMatches()
+#  returns (rows, lineCount, isInvalid), stopping at the first line that does not match
+def parseCSVByteRange(csvFile, start, end, rowRegex, parseMatchFct):
+  with open(csvFile, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      rangeBytes = mm[start:end]
+
+  rows = []
+  lineCount = 0
+  with io.TextIOWrapper(io.BytesIO(rangeBytes)) as lines:
+    for row in lines:
+      lineCount += 1
+      m = rowRegex.match(row.rstrip('\n'))
+      if not m:
+        return (rows, lineCount, True)
+      rows.append(parseMatchFct(m))
+  return (rows, lineCount, False)
+
+def readTextsFromCSV(csvFile):
+  return list(iterTextsFromCSV(csvFile))
+
+def iterTextsFromCSV(csvFile):
+  return iterCSVRecords(csvFile, SMS_CSV_ROW_REGEX, "SMS", parseTextCSVMatch, Text)
+
+def parseTextCSVMatch(m):
+  number           = m.group(1)
+  date_millis      = int(m.group(2))
+  date_sent_millis = int(m.group(3))
+  sms_mms_type     = m.group(4)
+  directionStr     = m.group(5)
+  date_format      = m.group(6)
+  body             = unescapeStr(m.group(7))
+
+  return ( number
+         , date_millis
+         , date_sent_millis
+         , sms_mms_type
+         , SMS_DIR.__members__[directionStr]
+         , date_format
+         , body
+         )
+
+#one row per eventId with its external date properties, joined onto Events
+#  in a single pass instead of a correlated subquery per event
+#  NOTE: both columns read 'external_date_sent_millis', as the readers always have
+def getExternalDatesPivotSql(eventIdFilterSql):
+  return (""
+    + " ( SELECT"
+    + "     eventId,"
+    + "     min(CASE WHEN key = 'external_date_sent_millis' THEN value END)"
+    + "       external_date_millis,"
+    + "     min(CASE WHEN key = 'external_date_sent_millis' THEN value END)"
+    + "       external_date_sent_millis"
+    + "   FROM EventProperties"
+    + "   WHERE key IN ('external_date_sent_millis')"
+    + "     AND " + eventIdFilterSql
+    + "   GROUP BY eventId"
+    + " )"
+  )
+
+#ids of events of :eventType with endTime >= :minEndTime (see getRecentMinEndTime())
+RECENT_EVENT_IDS_SQL = (""
+  + " ( SELECT id FROM Events"
+  + "   WHERE type = :eventType"
+  + "     AND endTime >= :minEndTime"
+  + " )"
+)
+
+#takes a :sinceEventId param, 0 for all events
+EXTERNAL_DATES_PIVOT_SQL = getExternalDatesPivotSql(
+  "eventId > :sinceEventId")
+#takes :eventType and :minEndTime params, only pivots the properties of those events
+RECENT_EXTERNAL_DATES_PIVOT_SQL = getExternalDatesPivotSql(
+  "eventId IN " + RECENT_EVENT_IDS_SQL)
+
+#write info and att files of each MMS into MMS_MSG_DIR/<getMsgDirName()>, only if changed
+def writeMMSMsgDirs(mmsMessages, mmsMsgDir, mmsPartsDir):
+  attFileCount = 0
+  attFileSkippedCount = 0
+  msgDirCreatedCount = 0
+  msgDirUpdatedCount = 0
+  msgDirUnchangedCount = 0
+  for msg in mmsMessages:
+    dirName = msg.getMsgDirName()
+    msgDir = mmsMsgDir + "/" + dirName
+    msgDirCreated = False
+    msgDirChanged = False
+    if not os.path.isdir(msgDir):
+      os.mkdir(msgDir)
+      msgDirCreated = True
+
+    infoFilePath = msgDir + "/" + "info"
+
+    oldInfo = None
+    if os.path.isfile(infoFilePath):
+      msg.mergeExistingToNumbersFromInfo(infoFilePath)
+      with open(infoFilePath, 'rb') as f:
+        oldInfo = f.read()
+
+    newInfo = msg.getInfo().encode('utf-8')
+    if newInfo != oldInfo:
+      with open(infoFilePath, 'wb') as f:
+        f.write(newInfo)
+      msgDirChanged = True
+    for attName in sorted(msg.attFiles.keys()):
+      srcFile = msg.attFiles[attName]
+      destFile = msgDir + "/" + attName
+      try:
+        copied = copyFilePreserve(srcFile, destFile)
+      except OSError as e:
+        print("failed to copy " + str(srcFile) + "\n" + str(e))
+        quit(1)
+      if copied:
+        attFileCount += 1
+        msgDirChanged = True
+      else:
+        attFileSkippedCount += 1
+
+    dateNs = msg.date_millis * 1000 * 1000
+    for path in [infoFilePath, msgDir]:
+      if os.stat(path).st_mtime_ns != dateNs:
+        os.utime(path, ns=(dateNs, dateNs))
+        msgDirChanged = True
+
+    if msgDirCreated:
+      msgDirCreatedCount += 1
+    elif msgDirChanged:
+      msgDirUpdatedCount += 1
+    else:
+      msgDirUnchangedCount += 1
+
+  print("copied " + str(attFileCount) + " files from " + mmsPartsDir
+    + " (skipped " + str(attFileSkippedCount) + " unchanged)")
+  print("MMS msg dirs: {0} created, {1} updated, {2} unchanged".format(
+    msgDirCreatedCount, msgDirUpdatedCount, msgDirUnchangedCount))
+
+#write one toCsv() line per item as it is generated, returns the number of lines
+def writeCsv(csvFile, items, append=False):
+  csvExport = CsvExportFile(csvFile, append)
+  try:
+    count = 0
+    for item in items:
+      csvExport.f.write(item.toCsv() + "\n")
+      count += 1
+    csvExport.finish()
+  finally:
+    csvExport.close()
+  return count
+
+#the CSV_FILE of an export, left as it was unless finish() is called,
+#  e.g.: when reading the events quits partway
+#  a new CSV_FILE is streamed into CSV_FILE.tmp, which replaces CSV_FILE in finish()
+#  when appending, CSV_FILE is truncated back to its original size in close(),
+#    so a retry does not append the same rows again (--state-file is not advanced)
+class CsvExportFile:
+  def __init__(self, csvFile, append):
+    self.csvFile = csvFile
+    self.append = append
+    self.origSize = None
+    if append:
+      self.writeFile = csvFile
+      if os.path.isfile(csvFile):
+        self.origSize = os.path.getsize(csvFile)
+    else:
+      self.writeFile = csvFile + ".tmp"
+    self.f = open(self.writeFile, 'a' if append else 'w', encoding='utf-8', newline='',
+                  buffering=EXPORT_WRITE_BUFFER_BYTES)
+    self.finished = False
+  def finish(self):
+    self.f.close()
+    if not self.append:
+      os.replace(self.writeFile, self.csvFile)
+    self.finished = True
+  #undoes the writes, unless finish() was called
+  def close(self):
+    if self.finished:
+      return
+    self.f.close()
+    if os.path.exists(self.writeFile):
+      if self.origSize != None:
+        os.truncate(self.writeFile, self.origSize)
+      else:
+        os.remove(self.writeFile)
+    self.finished = True
+
+def getMaxEventId(db_file, eventType=None):
+  conn = sqlite3.connect(db_file)
+  if eventType == None:
+    maxId = conn.execute("SELECT max(id) FROM Events;").fetchone()[0]
+  else:
+    maxId = conn.execute("SELECT max(id) FROM Events WHERE type = ?;",
+      (eventType,)).fetchone()[0]
+  conn.close()
+  if maxId == None:
+    maxId = 0
+  return int(maxId)
+
+#endTime of the count-th most recent event of eventType, or None if there are fewer
+#  date_millis is always in the same second as endTime,
+#  so the count most recent events all have endTime >= this
+def getRecentMinEndTime(db_file, eventType, count):
+  conn = sqlite3.connect(db_file)
+  row = conn.execute(""
+    + " SELECT endTime FROM Events"
+    + " WHERE type = ?"
+    + " ORDER BY endTime DESC"
+    + " LIMIT 1 OFFSET ?"
+    + ";", (eventType, count-1)).fetchone()
+  conn.close()
+  if row == None:
+    return None
+  return int(row[0])
+
+def readExportState(stateFile):
+  state = {}
+  if stateFile == None or not os.path.isfile(stateFile):
+    return state
+  with open(stateFile, 'r') as f:
+    for line in f.read().splitlines():
+      m = regexMatch(r'^(\w+)=(\d+)$', line)
+      if not m:
+        print("ERROR: malformed line in state file " + stateFile + ": " + line)
+        quit(1)
+      state[m.group(1)] = int(m.group(2))
+  return state
+
+def writeExportState(stateFile, state):
+  tmpFile = stateFile + ".tmp"
+  with open(tmpFile, 'w') as f:
+    for key in sorted(state.keys()):
+      f.write(key + "=" + str(state[key]) + "\n")
+  os.replace(tmpFile, stateFile)
+
+#returns (sinceEventId, highWaterMark)
+#  sinceEventId: export only events with a greater Events.id (0 for a full export)
+#  highWaterMark: max Events.id for this type, saved by finishIncrementalExport()
+#    pass it as the reader's maxEventId, so events inserted after this call
+#    are left for the next export instead of being exported twice
+def startIncrementalExport(args, stateKey):
+  eventType = EXPORT_STATE_EVENT_TYPES[stateKey]
+  sinceEventId = 0
+  if args.state_file != None:
+    state = readExportState(args.state_file)
+    if stateKey in state:
+      sinceEventId = state[stateKey]
+  if args.since_event_id != None:
+    sinceEventId = args.since_event_id
+
+  if sinceEventId > 0:
+    maxEventId = getMaxEventId(args.DB_FILE)
+    if maxEventId < sinceEventId:
+      print("WARNING: max Events.id " + str(maxEventId)
+        + " is less than last exported id " + str(sinceEventId)
+        + ", DB was replaced or reset, performing full export")
+      sinceEventId = 0
+    else:
+      print("incremental export of " + stateKey
+        + " events after Events.id=" + str(sinceEventId))
+
+  highWaterMark = max(sinceEventId, getMaxEventId(args.DB_FILE, eventType))
+  return (sinceEventId, highWaterMark)
+
+def finishIncrementalExport(args, stateKey, highWaterMark):
+  if args.state_file != None:
+    state = readExportState(args.state_file)
+    state[stateKey] = highWaterMark
+    writeExportState(args.state_file, state)
+
+def iterQueryRows(query, fetchSize=EXPORT_FETCH_SIZE):
+  while True:
+    rows = query.fetchmany(fetchSize)
+    if len(rows) == 0:
+      return
+    for row in rows:
+      yield row
 
 def readTextsFromCommHistory(db_file):
+  return list(iterTextsFromCommHistory(db_file))
+
+#minEndTime: if not None, only read events with endTime >= minEndTime
+#maxEventId: if not None, only read events with Events.id <= maxEventId
+#  (the highWaterMark of startIncrementalExport())
+def iterTextsFromCommHistory(db_file, sinceEventId=0, minEndTime=None, maxEventId=None):
   conn = sqlite3.connect(db_file)
   c = conn.cursor()
-  i=0
-  texts = []
+  pivotSql = EXTERNAL_DATES_PIVOT_SQL
+  if minEndTime != None:
+    pivotSql = RECENT_EXTERNAL_DATES_PIVOT_SQL
   query = c.execute(""
       + " SELECT"
+      + "   e.id,"
       + "   e.remoteUid,"
       + "   e.startTime,"
       + "   e.endTime,"
       + "   e.direction,"
       + "   e.freeText,"
-      + "   ( select min(value)"
-      + "     from EventProperties p"
-      + "     where p.eventid = e.id"
-      + "       and key = 'external_date_sent_millis'"
-      + "   ) external_date_millis,"
-      + "   ( select min(value)"
-      + "     from EventProperties p"
-      + "     where p.eventid = e.id"
-      + "       and key = 'external_date_sent_millis'"
-      + "   ) external_date_sent_millis"
+      + "   p.external_date_millis,"
+      + "   p.external_date_sent_millis"
       + " FROM events e"
-      + " WHERE e.type = 2"
+      + " LEFT OUTER JOIN " + pivotSql + " p"
+      + "   ON p.eventId = e.id"
+      + " WHERE e.type = :eventType"
+      + "   AND e.id > :sinceEventId"
+      + "   AND (:maxEventId IS NULL OR e.id <= :maxEventId)"
+      + "   AND (:minEndTime IS NULL OR e.endTime >= :minEndTime)"
       + " ORDER BY e.id ASC"
       + ";"
+      , { "eventType": 2
+        , "sinceEventId": sinceEventId
+        , "maxEventId": maxEventId
+        , "minEndTime": minEndTime
+        }
   )
-  for row in query:
-    number = row[0]
-    date_start_millis = int(row[1]) * 1000
-    date_end_millis = int(row[2]) * 1000
-    dir_type = row[3]
-    body = row[4]
-    external_date_millis = row[5]
-    external_date_sent_millis = row[6]
-
-    if dir_type == 2:
-      direction = SMS_DIR.OUT
-    elif dir_type == 1:
-      direction = SMS_DIR.INC
-    else:
-      print("INVALID SMS DIRECTION TYPE: " + str(dir_type) + "\n" + str(row))
-      quit(1)
+  for row in iterQueryRows(query):
+    txt = newTextFromEvent(*row)
+    if VERBOSE:
+      print(str(txt))
+    yield txt
+  conn.close()
 
-    sms_mms_type = "S"
-    date_millis = date_end_millis
-    date_sent_millis = date_start_millis
+#Text from the columns of an SMS Events row and its external date EventProperties
+def newTextFromEvent(event_id, number, startTime, endTime, dir_type, body,
+                     external_date_millis, external_date_sent_millis):
+  date_start_millis = int(startTime) * 1000
+  date_end_millis = int(endTime) * 1000
 
-    if external_date_millis != None and regexMatch(r'^\d+$', external_date_millis):
-      old_date_millis = date_millis
-      date_millis = int(external_date_millis)
-      if int(old_date_millis/1000) != int(date_millis/1000):
-        print("ERROR: invalid external_date_millis "
-          + external_date_millis + " for event_id " + event_id)
-        quit(1)
+  if dir_type == 2:
+    direction = SMS_DIR.OUT
+  elif dir_type == 1:
+    direction = SMS_DIR.INC
+  else:
+    print("INVALID SMS DIRECTION TYPE: " + str(dir_type) + " for event_id " + str(event_id))
+    quit(1)
 
-    if external_date_sent_millis != None and regexMatch(r'^\d+$', external_date_sent_millis):
-      old_date_sent_millis = date_sent_millis
-      date_sent_millis = int(external_date_sent_millis)
-      if int(old_date_sent_millis/1000) != int(date_sent_millis/1000):
-        print("ERROR: invalid external_date_sent_millis "
-          + external_date_sent_millis + " for event_id " + event_id)
-        quit(1)
+  sms_mms_type = "S"
+  date_millis = date_end_millis
+  date_sent_millis = date_start_millis
 
-    date_format = time.strftime("%Y-%m-%d %H:%M:%S",
-      time.localtime(date_millis/1000))
+  if external_date_millis != None and regexMatch(DIGITS_REGEX, external_date_millis):
+    old_date_millis = date_millis
+    date_millis = int(external_date_millis)
+    if int(old_date_millis/1000) != int(date_millis/1000):
+      print("ERROR: invalid external_date_millis "
+        + str(external_date_millis) + " for event_id " + str(event_id))
+      quit(1)
 
-    txt = Text(number, date_millis, date_sent_millis,
-      sms_mms_type, direction, date_format, body)
-    texts.append(txt)
-    if VERBOSE:
-      print(str(txt))
-  return texts
+  if external_date_sent_millis != None and regexMatch(DIGITS_REGEX, external_date_sent_millis):
+    old_date_sent_millis = date_sent_millis
+    date_sent_millis = int(external_date_sent_millis)
+    if int(old_date_sent_millis/1000) != int(date_sent_millis/1000):
+      print("ERROR: invalid external_date_sent_millis "
+        + str(external_date_sent_millis) + " for event_id " + str(event_id))
+      quit(1)
+
+  date_format = time.strftime("%Y-%m-%d %H:%M:%S",
+    time.localtime(date_millis/1000))
+
+  return Text(number, date_millis, date_sent_millis,
+    sms_mms_type, direction, date_format, body)
 
 def readCallsFromCommHistory(db_file):
+  return list(iterCallsFromCommHistory(db_file))
+
+#maxEventId: if not None, only read events with Events.id <= maxEventId
+def iterCallsFromCommHistory(db_file, sinceEventId=0, maxEventId=None):
   conn = sqlite3.connect(db_file)
   c = conn.cursor()
-  i=0
-  calls = []
   query = c.execute(""
       + " SELECT"
+      + "   e.id,"
       + "   e.remoteUid,"
       + "   e.startTime,"
       + "   e.endTime,"
       + "   e.direction,"
       + "   e.isMissedCall,"
       + "   e.headers,"
-      + "   ( select min(value)"
-      + "     from EventProperties p"
-      + "     where p.eventid = e.id"
-      + "       and key = 'external_date_sent_millis'"
-      + "   ) external_date_millis"
+      + "   p.external_date_millis"
       + " FROM events e"
+      + " LEFT OUTER JOIN " + EXTERNAL_DATES_PIVOT_SQL + " p"
+      + "   ON p.eventId = e.id"
       + " WHERE e.type = 3"
+      + "   AND e.id > :sinceEventId"
+      + "   AND (:maxEventId IS NULL OR e.id <= :maxEventId)"
       + " ORDER BY e.id ASC"
-      + ";")
-  for row in query:
-    number = row[0]
-    date_start_millis = int(row[1]) * 1000
-    date_end_millis = int(row[2]) * 1000
-    dir_type = row[3]
-    is_missed_call = row[4]
-    headersRejectedHack = row[5]
-    external_date_millis = row[6]
-
-    if headersRejectedHack != None and "rejected" in headersRejectedHack:
-      direction = CALL_DIR.REJ
-    elif int(is_missed_call) == 1:
-      direction = CALL_DIR.MIS
-    elif dir_type == 2:
-      direction = CALL_DIR.OUT
-    elif dir_type == 1:
-      direction = CALL_DIR.INC
-    else:
-      print("INVALID CALL DIRECTION TYPE: " + str(dir_type) + "\n" + str(row))
-      quit(1)
+      + ";"
+      , {"sinceEventId": sinceEventId, "maxEventId": maxEventId}
+  )
+  for row in iterQueryRows(query):
+    call = newCallFromEvent(*row)
+    if VERBOSE:
+      print(str(call))
+    yield call
+  conn.close()
+
+#Call from the columns of a call Events row and its external date EventProperties
+def newCallFromEvent(event_id, number, startTime, endTime, dir_type, is_missed_call,
+                     headersRejectedHack, external_date_millis):
+  date_start_millis = int(startTime) * 1000
+  date_end_millis = int(endTime) * 1000
+
+  if headersRejectedHack != None and "rejected" in headersRejectedHack:
+    direction = CALL_DIR.REJ
+  elif int(is_missed_call) == 1:
+    direction = CALL_DIR.MIS
+  elif dir_type == 2:
+    direction = CALL_DIR.OUT
+  elif dir_type == 1:
+    direction = CALL_DIR.INC
+  else:
+    print("INVALID CALL DIRECTION TYPE: " + str(dir_type) + " for event_id " + str(event_id))
+    quit(1)
 
-    date_millis = date_start_millis
-    durationSex = int((date_end_millis - date_start_millis)/1000)
+  date_millis = date_start_millis
+  durationSex = int((date_end_millis - date_start_millis)/1000)
 
-    if external_date_millis != None and regexMatch(r'^\d+$', external_date_millis):
-      old_date_millis = date_millis
-      date_millis = int(external_date_millis)
-      if int(old_date_millis/1000) != int(date_millis/1000):
-        print("ERROR: invalid external_date_millis "
-          + external_date_millis + " for event_id " + event_id)
-        quit(1)
+  if external_date_millis != None and regexMatch(DIGITS_REGEX, external_date_millis):
+    old_date_millis = date_millis
+    date_millis = int(external_date_millis)
+    if int(old_date_millis/1000) != int(date_millis/1000):
+      print("ERROR: invalid external_date_millis "
+        + str(external_date_millis) + " for event_id " + str(event_id))
+      quit(1)
 
-    date_format = time.strftime("%Y-%m-%d %H:%M:%S",
-      time.localtime(date_millis/1000))
+  date_format = time.strftime("%Y-%m-%d %H:%M:%S",
+    time.localtime(date_millis/1000))
 
-    if durationSex < 0:
-      durSign = "-"
-      durationSex = 0 - durationSex
-    else:
-      durSign = " "
-    durHrs = int(durationSex / 60 / 60)
-    durMin = int(durationSex / 60) % 60
-    durSec = int(durationSex) % 60
-    duration_format = "%s%01dh %02dm %02ds" % (durSign, durHrs, durMin, durSec)
-
-    call = Call(number, date_millis, direction, date_format, duration_format)
-    calls.append(call)
-    if VERBOSE:
-      print(str(call))
-  return calls
+  if durationSex < 0:
+    durSign = "-"
+    durationSex = 0 - durationSex
+  else:
+    durSign = " "
+  durHrs = int(durationSex / 60 / 60)
+  durMin = int(durationSex / 60) % 60
+  durSec = int(durationSex) % 60
+  duration_format = "%s%01dh %02dm %02ds" % (durSign, durHrs, durMin, durSec)
+
+  return Call(number, date_millis, direction, date_format, duration_format)
 
 def readMMSFromMsgDir(mmsMsgDir, mms_parts_dir):
   msgDirs = filter(lambda f: os.path.isdir(f), glob.glob(mmsMsgDir + "/*"))
@@ -944,11 +1782,25 @@ def readMMSFromMsgDir(mmsMsgDir, mms_parts_dir):
     mmsMessages.append(mms)
   return mmsMessages
 
-def readMMSFromCommHistory(db_file, mms_parts_dir, skipChecksums=False):
+#minEndTime: if not None, only read events with endTime >= minEndTime,
+#  and only the parts and groups of those events
+#maxEventId: if not None, only read events (and parts) with Events.id <= maxEventId
+#partsReader: if not None, an MMSPartsReader that fetches and parses the MessageParts
+#  of each MMS on first access, instead of reading all of them up front
+def readMMSFromCommHistory(db_file, mms_parts_dir, skipChecksums=False, sinceEventId=0,
+                           minEndTime=None, partsReader=None, maxEventId=None):
   conn = sqlite3.connect(db_file)
   c = conn.cursor()
   i=0
   texts = []
+  pivotSql = EXTERNAL_DATES_PIVOT_SQL
+  if minEndTime != None:
+    pivotSql = RECENT_EXTERNAL_DATES_PIVOT_SQL
+  params = { "eventType": 6
+           , "sinceEventId": sinceEventId
+           , "maxEventId": maxEventId
+           , "minEndTime": minEndTime
+           }
   query = c.execute(""
       + " SELECT"
       + "   e.id,"
@@ -960,96 +1812,150 @@ def readMMSFromCommHistory(db_file, mms_parts_dir, skipChecksums=False):
       + "   e.subject,"
       + "   e.freeText,"
       + "   e.headers,"
-      + "   ( select min(value)"
-      + "     from EventProperties p"
-      + "     where p.eventid = e.id"
-      + "       and key = 'external_date_sent_millis'"
-      + "   ) external_date_millis,"
-      + "   ( select min(value)"
-      + "     from EventProperties p"
-      + "     where p.eventid = e.id"
-      + "       and key = 'external_date_sent_millis'"
-      + "   ) external_date_sent_millis"
+      + "   p.external_date_millis,"
+      + "   p.external_date_sent_millis"
       + " FROM Events e"
-      + " WHERE e.type = 6"
+      + " LEFT OUTER JOIN " + pivotSql + " p"
+      + "   ON p.eventId = e.id"
+      + " WHERE e.type = :eventType"
+      + "   AND e.id > :sinceEventId"
+      + "   AND (:maxEventId IS NULL OR e.id <= :maxEventId)"
+      + "   AND (:minEndTime IS NULL OR e.endTime >= :minEndTime)"
       + " ORDER BY e.id ASC"
       + ";"
+      , params
   )
   msgs = {}
   event_groups = {}
+  event_numbers = {}
   for row in query:
-    event_id = row[0]
-    number = row[1]
-    group_id = row[2]
-    date_start_millis = int(row[3]) * 1000
-    date_end_millis = int(row[4]) * 1000
-    dir_type_mms = row[5]
-    subject = row[6]
-    body = row[7]
-    headers = row[8]
-    external_date_millis = row[9]
-    external_date_sent_millis = row[10]
-
-    date_millis = date_end_millis
-    date_sent_millis = date_start_millis
-
-    if external_date_millis != None and regexMatch(r'^\d+$', external_date_millis):
-      old_date_millis = date_millis
-      date_millis = int(external_date_millis)
-      if int(old_date_millis/1000) != int(date_millis/1000):
-        print("ERROR: invalid external_date_millis "
-          + external_date_millis + " for event_id " + event_id)
-        quit(1)
-
-    if external_date_sent_millis != None and regexMatch(r'^\d+$', external_date_sent_millis):
-      old_date_sent_millis = date_sent_millis
-      date_sent_millis = int(external_date_sent_millis)
-      if int(old_date_sent_millis/1000) != int(date_sent_millis/1000):
-        print("ERROR: invalid external_date_sent_millis "
-          + external_date_sent_millis + " for event_id " + event_id)
-        quit(1)
-
-    if subject == None:
-      subject = ""
-    if body == None:
-      body = ""
+    (event_id, number, group_id) = row[0:3]
+    msgs[event_id] = newMMSFromEvent(mms_parts_dir, event_id, *row[3:])
+    event_groups[event_id] = group_id
+    event_numbers[event_id] = number
+
+  if partsReader != None:
+    partsReader.addEventIds(msgs.keys())
+    for (event_id, msg) in msgs.items():
+      msg.setPartsLoader(partsReader, event_id)
+    partRows = None
+  elif minEndTime == None:
+    partRows = c.execute(
+      'SELECT eventId, contentType, path \
+       FROM messageParts \
+       WHERE eventId IS NULL \
+          OR (eventId > :sinceEventId AND (:maxEventId IS NULL OR eventId <= :maxEventId)) \
+       ORDER BY id ASC;', params)
+  else:
+    partRows = c.execute(
+      'SELECT eventId, contentType, path \
+       FROM messageParts \
+       WHERE eventId IN ' + RECENT_EVENT_IDS_SQL + ' \
+       ORDER BY id ASC;', params)
+
+  return finishMMSFromCommHistory(c, db_file, msgs, event_groups, event_numbers,
+    partRows, skipChecksums)
+
+#MMS from the columns of an MMS Events row and its external date EventProperties
+#  from_number, and to_numbers other than the x-mms-to header, are added from the
+#  event group by finishMMSFromCommHistory()
+def newMMSFromEvent(mms_parts_dir, event_id, startTime, endTime, dir_type_mms,
+                    subject, body, headers, external_date_millis, external_date_sent_millis):
+  date_start_millis = int(startTime) * 1000
+  date_end_millis = int(endTime) * 1000
+
+  date_millis = date_end_millis
+  date_sent_millis = date_start_millis
+
+  if external_date_millis != None and regexMatch(DIGITS_REGEX, external_date_millis):
+    old_date_millis = date_millis
+    date_millis = int(external_date_millis)
+    if int(old_date_millis/1000) != int(date_millis/1000):
+      print("ERROR: invalid external_date_millis "
+        + str(external_date_millis) + " for event_id " + str(event_id))
+      quit(1)
 
-    if dir_type_mms == 2:
-      direction = MMS_DIR.OUT
-    elif dir_type_mms == 1:
-      direction = MMS_DIR.INC
-    else:
-      print("INVALID MMS DIRECTION TYPE: " + str(dir_type_mms) + "\n" + str(row))
+  if external_date_sent_millis != None and regexMatch(DIGITS_REGEX, external_date_sent_millis):
+    old_date_sent_millis = date_sent_millis
+    date_sent_millis = int(external_date_sent_millis)
+    if int(old_date_sent_millis/1000) != int(date_sent_millis/1000):
+      print("ERROR: invalid external_date_sent_millis "
+        + str(external_date_sent_millis) + " for event_id " + str(event_id))
       quit(1)
 
-    date_format = time.strftime("%Y-%m-%d %H:%M:%S",
-      time.localtime(date_millis/1000))
+  if subject == None:
+    subject = ""
+  if body == None:
+    body = ""
 
-    msg = MMS(mms_parts_dir)
-    msg.date_millis = date_millis
-    msg.date_sent_millis = date_sent_millis
-    msg.direction = direction
-    msg.date_format = date_format
-    msg.subject = subject
-    msg.body = body
+  if dir_type_mms == 2:
+    direction = MMS_DIR.OUT
+  elif dir_type_mms == 1:
+    direction = MMS_DIR.INC
+  else:
+    print("INVALID MMS DIRECTION TYPE: " + str(dir_type_mms) + " for event_id " + str(event_id))
+    quit(1)
 
-    if headers != None:
-      m = regexMatch(r'x-mms-to(?:\u001D)?([0-9\+\u001E]*)', headers, re.IGNORECASE)
-      if m:
-        nums = regexSplit(r'[\+\u001E]+', m.group(1))
-        for num in nums:
-          if num != None and regexMatch(r'\d', num):
-            msg.to_numbers.append(cleanNumber(num))
+  date_format = time.strftime("%Y-%m-%d %H:%M:%S",
+    time.localtime(date_millis/1000))
+
+  msg = MMS(mms_parts_dir)
+  msg.date_millis = date_millis
+  msg.date_sent_millis = date_sent_millis
+  msg.direction = direction
+  msg.date_format = date_format
+  msg.subject = subject
+  msg.body = body
+
+  if headers != None:
+    m = regexMatch(MMS_TO_HEADER_REGEX, headers)
+    if m:
+      nums = regexSplit(MMS_TO_HEADER_SEP_REGEX, m.group(1))
+      for num in nums:
+        if num != None and regexMatch(HAS_DIGIT_REGEX, num):
+          msg.to_numbers.append(cleanNumber(num))
+
+  return msg
+
+#add the MessageParts partRows, checksums and group numbers to msgs, by Events.id
+#  partRows is None if the parts are fetched lazily, by an MMSPartsReader
+#  returns the MMS messages, in Events.id order
+def finishMMSFromCommHistory(c, db_file, msgs, event_groups, event_numbers,
+                             partRows, skipChecksums):
+  if partRows != None:
+    addMMSPartsFromCommHistory(msgs, partRows, skipChecksums)
+
+  groupResolver = getGroupResolver(db_file, c)
 
-    msgs[event_id] = msg
-    event_groups[event_id] = group_id
+  for event_id in msgs.keys():
+    msg = msgs[event_id]
+    group_id = event_groups[event_id]
+    groupNumbers = groupResolver.getGroupNumbers(group_id)
+    if groupNumbers == None:
+      print("INVALID GROUP ID: " + str(group_id) + "\n" + str(msg))
+      quit(1)
+    if msg.direction == MMS_DIR.OUT:
+      msg.from_number = cleanNumber(MY_NUMBER)
+      msg.to_numbers.extend(groupNumbers)
+    elif msg.direction == MMS_DIR.INC:
+      if len(groupNumbers) == 1:
+        msg.from_number = groupNumbers[0]
+      else:
+        #multi-party group, the sender is the Events.remoteUid
+        msg.from_number = cleanNumber(event_numbers[event_id])
+      msg.to_numbers.append(cleanNumber(MY_NUMBER))
+      msg.to_numbers.extend([num for num in groupNumbers if num != msg.from_number])
+
+  #TO is from x-mms-to header and event groups
+  for event_id in msgs.keys():
+    msg = msgs[event_id]
+    msg.to_numbers = uniq(msg.to_numbers)
 
-  query = c.execute(
-    'SELECT eventId, contentType, path \
-     FROM messageParts \
-     ORDER BY id ASC;')
+  return msgs.values()
 
-  for row in query:
+#add the MessageParts partRows to msgs, by Events.id, and parse them
+def addMMSPartsFromCommHistory(msgs, partRows, skipChecksums):
+  for row in partRows:
     event_id = row[0]
     part_type = row[1]
     filepath = row[2]
@@ -1063,106 +1969,278 @@ def readMMSFromCommHistory(db_file, mms_parts_dir, skipChecksums=False):
       quit(1)
     msg = msgs[event_id]
 
-    part = MMSPart()
-    part.part_type = part_type
-    part.filepath = filepath
-    msg.parts.append(part)
+    msg.parts.append(MMSPart(part_type, filepath))
 
   for msg in msgs.values():
-    msg.parseParts(skipChecksum=skipChecksums)
-
-  query = c.execute(
-    'SELECT id, remoteUids \
-     FROM groups \
-     ORDER BY id ASC;')
-
-  group_numbers = {}
-  for row in query:
-    group_id = int(row[0])
-    numbers = row[1]
-    group_numbers[group_id] = numbers
+    msg.parseParts(skipChecksum=True)
+  if not skipChecksums:
+    checksums = generateMMSChecksums(msgs.values())
+    for (msg, checksum) in zip(msgs.values(), checksums):
+      msg.checksum = checksum
+
+#export-from-db-sms, export-from-db-calls and export-from-db-mms in one pass over Events
+#  SMS and calls are written to smsCsvFile/callCsvFile as they are read,
+#  sharing one EventProperties pivot, MMS are returned for writeMMSMsgDirs()
+#  sinceEventIds: Events.id to export after, for each of "sms", "calls" and "mms"
+#  maxEventIds: highWaterMark of startIncrementalExport() for each of them,
+#    Events.id to export up to
+#  returns (smsCount, callCount, mmsMessages)
+def exportAllFromCommHistory(db_file, smsCsvFile, callCsvFile, mms_parts_dir,
+                             sinceEventIds, maxEventIds):
+  conn = sqlite3.connect(db_file)
+  c = conn.cursor()
+  query = c.execute(""
+      + " SELECT"
+      + "   e.id,"
+      + "   e.type,"
+      + "   e.remoteUid,"
+      + "   e.groupId,"
+      + "   e.startTime,"
+      + "   e.endTime,"
+      + "   e.direction,"
+      + "   e.isMissedCall,"
+      + "   e.subject,"
+      + "   e.freeText,"
+      + "   e.headers,"
+      + "   p.external_date_millis,"
+      + "   p.external_date_sent_millis"
+      + " FROM Events e"
+      + " LEFT OUTER JOIN " + EXTERNAL_DATES_PIVOT_SQL + " p"
+      + "   ON p.eventId = e.id"
+      + " WHERE e.type IN (2, 3, 6)"
+      + "   AND e.id > :sinceEventId"
+      + "   AND e.id <= :maxEventId"
+      + " ORDER BY e.id ASC"
+      + ";"
+      , { "sinceEventId": min(sinceEventIds.values())
+        , "maxEventId": max(maxEventIds.values())
+        }
+  )
 
-  for event_id in msgs.keys():
-    msg = msgs[event_id]
-    group_id = event_groups[event_id]
-    if group_id not in group_numbers:
-      print("INVALID GROUP ID: " + str(group_id) + "\n" + str(msg))
-      quit(1)
-    groupNumber = group_numbers[group_id]
-    if msg.direction == MMS_DIR.OUT:
-      msg.from_number = cleanNumber(MY_NUMBER)
-      msg.to_numbers.append(cleanNumber(groupNumber))
-    elif msg.direction == MMS_DIR.INC:
-      msg.from_number = cleanNumber(groupNumber)
-      msg.to_numbers.append(cleanNumber(MY_NUMBER))
+  smsCount = 0
+  callCount = 0
+  msgs = {}
+  event_groups = {}
+  event_numbers = {}
+  #the CSVs are only finished once the MMS are read too, since any of them can quit
+  smsExport = CsvExportFile(smsCsvFile, sinceEventIds["sms"] > 0)
+  callExport = CsvExportFile(callCsvFile, sinceEventIds["calls"] > 0)
+  try:
+    for row in iterQueryRows(query):
+      (event_id, eventType, number, group_id, startTime, endTime, dir_type,
+        is_missed_call, subject, body, headers,
+        external_date_millis, external_date_sent_millis) = row
+      if eventType == 2 and sinceEventIds["sms"] < event_id <= maxEventIds["sms"]:
+        txt = newTextFromEvent(event_id, number, startTime, endTime, dir_type, body,
+          external_date_millis, external_date_sent_millis)
+        if VERBOSE:
+          print(str(txt))
+        smsExport.f.write(txt.toCsv() + "\n")
+        smsCount += 1
+      elif eventType == 3 and sinceEventIds["calls"] < event_id <= maxEventIds["calls"]:
+        call = newCallFromEvent(event_id, number, startTime, endTime, dir_type,
+          is_missed_call, headers, external_date_millis)
+        if VERBOSE:
+          print(str(call))
+        callExport.f.write(call.toCsv() + "\n")
+        callCount += 1
+      elif eventType == 6 and sinceEventIds["mms"] < event_id <= maxEventIds["mms"]:
+        msgs[event_id] = newMMSFromEvent(mms_parts_dir, event_id, startTime, endTime, dir_type,
+          subject, body, headers, external_date_millis, external_date_sent_millis)
+        event_groups[event_id] = group_id
+        event_numbers[event_id] = number
+
+    partRows = c.execute(
+      'SELECT eventId, contentType, path \
+       FROM messageParts \
+       WHERE eventId IS NULL OR (eventId > :sinceEventId AND eventId <= :maxEventId) \
+       ORDER BY id ASC;',
+      {"sinceEventId": sinceEventIds["mms"], "maxEventId": maxEventIds["mms"]})
+    mmsMessages = finishMMSFromCommHistory(c, db_file, msgs, event_groups, event_numbers,
+      partRows, False)
+
+    smsExport.finish()
+    callExport.finish()
+  finally:
+    smsExport.close()
+    callExport.close()
+  conn.close()
+  return (smsCount, callCount, mmsMessages)
 
-  #TO is from x-mms-to header and event groups
-  for event_id in msgs.keys():
-    msg = msgs[event_id]
-    msg.to_numbers = uniq(msg.to_numbers)
+def readCallsFromCSV(csvFile):
+  return list(iterCallsFromCSV(csvFile))
 
-  return msgs.values()
+def iterCallsFromCSV(csvFile):
+  return iterCSVRecords(csvFile, CALL_CSV_ROW_REGEX, "CALL", parseCallCSVMatch, Call)
 
-def readCallsFromCSV(csvFile):
-  try:
-    csvFile = open(csvFile, 'r')
-    csvContents = csvFile.read()
-    csvFile.close()
-  except IOError:
-    print("could not read csv file: " + str(csvFile))
-    quit(1)
+def parseCallCSVMatch(m):
+  number           = m.group(1)
+  date_millis      = int(m.group(2))
+  directionStr     = m.group(3)
+  date_format      = m.group(4)
+  duration_format  = m.group(5)
 
-  texts = []
-  rowRegex = re.compile(''
-    + r'([0-9+]+),'
-    + r'(\d+),'
-    + r'(' + '|'.join(sorted(CALL_DIR.__members__.keys())) + r'),'
-    + r'([^,]*),'
-    + r'(\s*-?\s*\d+h\s*\d+m\s*\d+s)'
-    )
-  for row in csvContents.splitlines():
-    m = rowRegex.match(row)
-    if not m or len(m.groups()) != 5:
-      print("invalid CALL CSV line: " + row)
-      quit(1)
-    number           = m.group(1)
-    date_millis      = int(m.group(2))
-    directionStr     = m.group(3)
-    date_format      = m.group(4)
-    duration_format  = m.group(5)
-
-    texts.append(Call( number
-                     , date_millis
-                     , CALL_DIR.__members__[directionStr]
-                     , date_format
-                     , duration_format
-                     ))
-  return texts
+  return ( number
+         , date_millis
+         , CALL_DIR.__members__[directionStr]
+         , date_format
+         , duration_format
+         )
 
 def readContactsCSV(csvFile):
-  try:
-    csvFile = open(csvFile, 'r')
-    csvContents = csvFile.read()
-    csvFile.close()
-  except IOError:
-    print("could not read csv file: " + str(csvFile))
-    quit(1)
-
   contacts = dict()
   rowRegex = re.compile(''
     + r'([0-9+]+),'
     + r'(.+)'
     )
-  for row in csvContents.splitlines():
-    m = rowRegex.match(row)
-    if not m or len(m.groups()) != 2:
-      print("invalid contacts CSV line: " + row)
-      quit(1)
+  for m in iterCSVMatches(csvFile, rowRegex, "contacts"):
     contactNumber = m.group(1)
     contactName = m.group(2)
     contacts[contactNumber] = contactName
   return contacts
 
+#CONTACTS_CSV names, looked up by the last CONTACT_NUMBER_SUFFIX_DIGITS digits of the number
+#  so '+15551234567', '15551234567' and '5551234567' all match, preferring the exact digits
+#  the index is rebuilt from csvFile only when its path, size or mtime changes
+#  indexFile=None builds the index in memory
+class ContactIndex:
+  def __init__(self, indexFile, csvFile):
+    createSourceTableSql = (""
+      + " CREATE TABLE IF NOT EXISTS contacts_csv ("
+      + "   path TEXT,"
+      + "   size INTEGER,"
+      + "   mtime_ns INTEGER"
+      + " );")
+    if indexFile == None:
+      self.conn = sqlite3.connect(":memory:")
+      self.conn.execute(createSourceTableSql)
+    else:
+      self.conn = openCacheDb(indexFile, createSourceTableSql)
+    self.conn.execute(""
+      + " CREATE TABLE IF NOT EXISTS contact ("
+      + "   suffix TEXT,"
+      + "   digits TEXT,"
+      + "   name TEXT"
+      + " );")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS contact_suffix ON contact (suffix);")
+
+    csvPath = os.path.abspath(csvFile)
+    try:
+      st = os.stat(csvPath)
+    except OSError:
+      print("could not read csv file: " + str(csvFile))
+      quit(1)
+    source = (csvPath, st.st_size, st.st_mtime_ns)
+    if self.conn.execute("SELECT path, size, mtime_ns FROM contacts_csv;").fetchall() != [source]:
+      self.rebuild(csvFile, source)
+  def rebuild(self, csvFile, source):
+    contacts = readContactsCSV(csvFile)
+    if VERBOSE:
+      print("rebuilding contacts index for " + str(len(contacts)) + " contacts")
+    self.conn.execute("DELETE FROM contacts_csv;")
+    self.conn.execute("DELETE FROM contact;")
+    self.conn.executemany("INSERT INTO contact (suffix, digits, name) VALUES (?, ?, ?);",
+      [(getContactNumberSuffix(digits), digits, name)
+       for (digits, name) in [(getNumberDigits(n), contacts[n]) for n in contacts]])
+    self.conn.execute("INSERT INTO contacts_csv (path, size, mtime_ns) VALUES (?, ?, ?);",
+      source)
+    self.conn.commit()
+  #contact name, or None if no contact has the same number suffix
+  def lookup(self, number):
+    digits = getNumberDigits(number)
+    row = self.conn.execute(""
+      + " SELECT name FROM contact"
+      + " WHERE suffix = ?"
+      + " ORDER BY digits = ? DESC, rowid DESC"
+      + " LIMIT 1;", (getContactNumberSuffix(digits), digits)).fetchone()
+    if row == None:
+      return None
+    return row[0]
+  def close(self):
+    self.conn.close()
+
+def getNumberDigits(number):
+  if number == None:
+    number = ''
+  return NON_DIGIT_CHARS_REGEX.sub('', number)
+
+def getContactNumberSuffix(digits):
+  return digits[-CONTACT_NUMBER_SUFFIX_DIGITS:]
+
+#records sorted by date_millis (stable sort), followed by [-limit:] if limit > 0
+#  checks the date_millis column first, since CSV backups are usually already sorted,
+#  and with a limit, selects the top-k instead of sorting everything
+def sortRecordsByDate(records, limit=0):
+  dateMillis = list(map(operator.attrgetter('date_millis'), records))
+  isSorted = all(map(operator.le, dateMillis, itertools.islice(dateMillis, 1, None)))
+  if isSorted:
+    records = list(records)
+  elif 0 < limit < len(records):
+    #prefer later records on ties, same as a full sort followed by [-limit:]
+    idxs = heapq.nlargest(limit, reversed(range(len(records))), key=dateMillis.__getitem__)
+    idxs.sort()
+    idxs.sort(key=dateMillis.__getitem__)
+    records = [records[i] for i in idxs]
+  else:
+    records = sorted(records, key=operator.attrgetter('date_millis'))
+  if limit > 0:
+    records = records[ (-limit) : ]
+  return records
+
+def prepareTextsForImport(texts, limit):
+  ignoredMissingNumberCount = 0
+  ignoredMMSToSMSCount = 0
+  okMessages = []
+  for txt in texts:
+    if txt.number == None or len(txt.number) == 0:
+      ignoredMissingNumberCount += 1
+    elif txt.sms_mms_type == "M":
+      ignoredMMSToSMSCount += 1
+    else:
+      okMessages.append(txt)
+  texts = okMessages
+
+  print("ignoring:")
+  print(" %5d SMS missing number" % ignoredMissingNumberCount)
+  print(" %5d MMS-to-SMS messages\n" % ignoredMMSToSMSCount)
+
+  print("sorting all {0} texts by date".format(len(texts)))
+  if limit > 0:
+    print("saving only the last {0} texts".format(limit))
+  return sortRecordsByDate(texts, limit)
+
+def prepareCallsForImport(calls, limit):
+  print("sorting all {0} calls by date".format(len(calls)))
+  if limit > 0:
+    print("saving only the last {0} calls".format(limit))
+  return sortRecordsByDate(calls, limit)
+
+def prepareMMSForImport(mmsMessages, limit):
+  ignoredNTFCount = 0
+  ignoredMissingToCount = 0
+  ignoredMissingFromCount = 0
+  okMessages = []
+  for mms in mmsMessages:
+    if mms.direction == MMS_DIR.NTF:
+      ignoredNTFCount += 1
+    elif len(mms.to_numbers) < 1:
+      ignoredMissingToCount += 1
+    elif mms.from_number == None or mms.from_number == "":
+      ignoredMissingFromCount += 1
+    else:
+      okMessages.append(mms)
+  mmsMessages = okMessages
+
+  print("ignoring:")
+  print(" %5d NTF MMS" % ignoredNTFCount)
+  print(" %5d MMS missing 'to' number\n" % ignoredMissingToCount)
+  print(" %5d MMS missing 'from' number\n" % ignoredMissingFromCount)
+
+  print("sorting all {0} MMS messages by date".format(len(mmsMessages)))
+  if limit > 0:
+    print("saving only the last {0} MMS messages".format(limit))
+  return sortRecordsByDate(mmsMessages, limit)
+
 def getDbTableNames(db_file):
   cur = sqlite3.connect(db_file).cursor()
   names = cur.execute("SELECT name FROM sqlite_master WHERE type='table'; ")
@@ -1170,6 +2248,118 @@ def getDbTableNames(db_file):
   cur.close()
   return names
 
+def connectImportDb(db_file):
+  conn = sqlite3.connect(db_file)
+  if BULK:
+    for (pragma, val) in BULK_IMPORT_PRAGMAS:
+      conn.execute("PRAGMA " + pragma + " = " + val + ";")
+  return conn
+
+def readPragmas(conn, pragmas):
+  return [(pragma, str(conn.execute("PRAGMA " + pragma + ";").fetchone()[0]))
+          for pragma in pragmas]
+
+def runDbImport(importFct, items, db_file):
+  if not BULK:
+    importFct(items, db_file)
+    return
+
+  bulkDbFile = db_file + ".bulk-import-tmp"
+  if os.path.exists(bulkDbFile):
+    print("ERROR: " + bulkDbFile + " already exists (left over from a failed --bulk?)")
+    quit(1)
+
+  try:
+    print("--bulk: copying " + db_file + " to " + bulkDbFile)
+    srcConn = sqlite3.connect(db_file)
+    bulkConn = sqlite3.connect(bulkDbFile)
+    srcConn.backup(bulkConn)
+    srcConn.close()
+
+    origPragmas = readPragmas(bulkConn, [pragma for (pragma, val) in BULK_IMPORT_PRAGMAS])
+
+    indexSqls = []
+    query = bulkConn.execute(""
+      + " SELECT name, sql"
+      + " FROM sqlite_master"
+      + " WHERE type = 'index'"
+      + "   AND sql IS NOT NULL"
+      + "   AND lower(tbl_name) IN (" + ", ".join(["?"] * len(BULK_IMPORT_INDEX_TABLES)) + ")"
+      + " ORDER BY rowid ASC"
+      + ";", BULK_IMPORT_INDEX_TABLES)
+    for (indexName, indexSql) in query.fetchall():
+      bulkConn.execute("DROP INDEX \"" + indexName + "\";")
+      indexSqls.append(indexSql)
+
+    triggerSqls = []
+    query = bulkConn.execute(""
+      + " SELECT name, sql"
+      + " FROM sqlite_master"
+      + " WHERE type = 'trigger'"
+      + "   AND lower(name) IN (" + ", ".join(["?"] * len(BULK_IMPORT_DROPPED_TRIGGERS)) + ")"
+      + " ORDER BY rowid ASC"
+      + ";", BULK_IMPORT_DROPPED_TRIGGERS)
+    for (triggerName, triggerSql) in query.fetchall():
+      bulkConn.execute("DROP TRIGGER \"" + triggerName + "\";")
+      triggerSqls.append(triggerSql)
+
+    firstEventId = getNextAutoIncrementId(bulkConn.cursor(), "events")
+    bulkConn.commit()
+    bulkConn.close()
+    print("--bulk: dropped " + str(len(indexSqls)) + " indexes"
+      + " and " + str(len(triggerSqls)) + " flag triggers")
+
+    importFct(items, bulkDbFile)
+
+    if NO_COMMIT:
+      print("--bulk: discarding " + bulkDbFile)
+      return
+
+    print("--bulk: rebuilding " + str(len(indexSqls)) + " indexes"
+      + " and " + str(len(triggerSqls)) + " flag triggers")
+    bulkConn = sqlite3.connect(bulkDbFile)
+    for indexSql in indexSqls:
+      bulkConn.execute(indexSql)
+    for triggerSql in triggerSqls:
+      bulkConn.execute(triggerSql)
+    bulkConn.commit()
+
+    badFlagCount = verifyEventFlags(bulkConn, firstEventId)
+    if badFlagCount > 0:
+      print("ERROR: --bulk: " + str(badFlagCount) + " imported events have"
+        + " hasExtraProperties/hasMessageParts that do not match EventProperties/MessageParts,"
+        + " leaving " + db_file + " untouched")
+      quit(1)
+    print("--bulk: verified hasExtraProperties/hasMessageParts of imported events")
+    for (pragma, val) in origPragmas:
+      bulkConn.execute("PRAGMA " + pragma + " = " + val + ";")
+    bulkConn.close()
+
+    #flush any WAL into db_file, so a stale -wal is not applied on top of the copy
+    srcConn = sqlite3.connect(db_file)
+    srcConn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    srcConn.close()
+
+    os.replace(bulkDbFile, db_file)
+    print("--bulk: replaced " + db_file)
+  finally:
+    if os.path.exists(bulkDbFile):
+      os.remove(bulkDbFile)
+
+#number of Events with id >= firstEventId whose flags differ from what the
+#  eventproperties_flag_insert/messageparts_flag_insert triggers would have set
+def verifyEventFlags(conn, firstEventId):
+  return conn.execute(""
+    + " SELECT count(*)"
+    + " FROM Events e"
+    + " WHERE e.id >= ?"
+    + "   AND ( e.hasExtraProperties IS NOT"
+    + "           EXISTS (SELECT 1 FROM EventProperties p WHERE p.eventId = e.id)"
+    + "      OR e.hasMessageParts IS NOT"
+    + "           EXISTS (SELECT 1 FROM MessageParts m WHERE m.eventId = e.id)"
+    + "       )"
+    + ";", (firstEventId,)).fetchone()[0]
+
 def insertRow(cursor, tableName, colVals):
   (colNames, values) = zip(*colVals.items())
   valuePlaceHolders = list(map(lambda val: "?", values))
@@ -1178,49 +2368,268 @@ def insertRow(cursor, tableName, colVals):
                 + " VALUES (" + ", ".join(valuePlaceHolders) + ")"
                 , values)
 
-def ensureGroupNumbersInserted(cursor, numbers):
-  groupIdByNumber = {}
-  query = cursor.execute("SELECT id, remoteUids FROM groups;")
-  maxGroupId = 0
-  for row in query:
-    groupId = int(row[0])
-    remoteUids = row[1]
-
-    if groupId > maxGroupId:
-      maxGroupId = groupId
-
-    if "|" not in remoteUids:
-      number = remoteUids
-      number = cleanNumber(number)
-      groupIdByNumber[number] = groupId
-
-  for number in numbers:
-    #add new group if necessary
-    if not number in groupIdByNumber:
-      maxGroupId += 1
-      insertRow(cursor, "groups", { "id": maxGroupId
-                                  , "localUid": LOCAL_UID
-                                  , "remoteUids": number
-                                  , "type": 0
-                                  , "chatName": ""
-                                  , "lastModified": 0
-                                  })
-      groupIdByNumber[number] = maxGroupId
+#INSERT statement with named placeholders, for executemany() with a list of dicts
+def prepareInsertSql(tableName, colNames):
+  valuePlaceHolders = list(map(lambda colName: ":" + colName, colNames))
+  return ( " INSERT INTO " + tableName
+         + " (" + ", ".join(colNames) + ")"
+         + " VALUES (" + ", ".join(valuePlaceHolders) + ")"
+         )
+
+#the id that sqlite would assign to the next AUTOINCREMENT row in tableName
+def getNextAutoIncrementId(cursor, tableName):
+  maxId = cursor.execute("SELECT max(id) FROM " + tableName + ";").fetchone()[0]
+  seq = cursor.execute(
+    "SELECT max(seq) FROM sqlite_sequence WHERE lower(name) = lower(?);",
+    (tableName,)).fetchone()[0]
+  if maxId == None:
+    maxId = 0
+  if seq == None:
+    seq = 0
+  return max(int(maxId), int(seq)) + 1
+
+def iterChunks(items, chunkSize):
+  it = iter(items)
+  while True:
+    chunk = list(itertools.islice(it, chunkSize))
+    if len(chunk) == 0:
+      return
+    yield chunk
+
+#the GroupResolver of db_file, loading the groups table with cursor on first use
+#  shared by the readers and importers for the rest of the process
+#  (groups are only ever added, and only by GroupResolver.ensureGroupsInserted())
+def getGroupResolver(db_file, cursor):
+  key = os.path.abspath(db_file)
+  if key not in GROUP_RESOLVERS:
+    GROUP_RESOLVERS[key] = GroupResolver(cursor)
+  return GROUP_RESOLVERS[key]
+
+#the cleanNumber()s in Groups.remoteUids, which is '|'-separated for multi-party groups
+def getGroupNumbers(remoteUids):
+  if remoteUids == None:
+    remoteUids = ""
+  return uniq([cleanNumber(number) for number in remoteUids.split("|")])
+
+#(number,) for a 1-to-1 group, or the sorted numbers of a multi-party group
+def getGroupKey(numbers):
+  numbers = uniq(numbers)
+  if len(numbers) == 1:
+    return (numbers[0],)
+  return tuple(sorted(numbers))
+
+#Groups.id by getGroupKey(), and numbers by Groups.id, read from the groups table once
+#  if several groups have the same numbers, the one with the highest id is used
+class GroupResolver:
+  def __init__(self, cursor):
+    self.groupIdByKey = {}
+    self.numbersByGroupId = {}
+    query = cursor.execute("SELECT id, remoteUids FROM groups ORDER BY id ASC;")
+    for (groupId, remoteUids) in query:
+      numbers = getGroupNumbers(remoteUids)
+      self.numbersByGroupId[int(groupId)] = numbers
+      self.groupIdByKey[getGroupKey(numbers)] = int(groupId)
+  def getGroupNumbers(self, groupId):
+    return self.numbersByGroupId.get(groupId)
+  def getGroupId(self, groupKey):
+    return self.groupIdByKey[groupKey]
+  #insert a group for each groupKey that does not have one yet, in order, in one executemany()
+  def ensureGroupsInserted(self, cursor, groupKeys):
+    groupId = getNextAutoIncrementId(cursor, "groups")
+    groupRows = []
+    for groupKey in groupKeys:
+      if groupKey in self.groupIdByKey:
+        continue
+      groupRows.append({ "id":           groupId
+                       , "localUid":     LOCAL_UID
+                       , "remoteUids":   "|".join(groupKey)
+                       , "type":         0
+                       , "chatName":     ""
+                       , "lastModified": 0
+                       })
+      self.groupIdByKey[groupKey] = groupId
+      self.numbersByGroupId[groupId] = list(groupKey)
 
       if VERBOSE:
-        print("added new group: " + str(number) + " => " + str(groupId))
+        print("added new group: " + "|".join(groupKey) + " => " + str(groupId))
+      groupId += 1
+    cursor.executemany(prepareInsertSql("groups", GROUPS_INSERT_COLS), groupRows)
+
+#--commit-every and --resume, for items sorted by date_millis
+#  commits every COMMIT_EVERY items, and saves the date_millis of the last committed item,
+#  along with how many committed items have that date_millis, in IMPORT_CHECKPOINT_TABLE
+#  (one row per stateKey, written in the same transaction as the items it covers)
+#  the count is of items in the list returned by skipImported(), so it includes items
+#  between the inserted ones that were left out afterwards, e.g.: by --skip-existing
+class ImportCheckpoint:
+  def __init__(self, conn, stateKey):
+    self.conn = conn
+    self.stateKey = stateKey
+    self.enabled = COMMIT_EVERY > 0 or RESUME
+    self.dateMillis = None
+    self.dateMillisCount = 0
+    self.uncommittedCount = 0
+    self.pendingItems = []
+    self.pendingIndex = 0
+  def hasTable(self):
+    return self.conn.execute(""
+      + " SELECT count(*) FROM sqlite_master"
+      + " WHERE type = 'table' AND name = ?"
+      + ";", (IMPORT_CHECKPOINT_TABLE,)).fetchone()[0] > 0
+  def skipImported(self, items):
+    items = self.skipCheckpointItems(items)
+    if self.enabled:
+      self.pendingItems = items
+    return items
+  def skipCheckpointItems(self, items):
+    if not RESUME:
+      return items
+    row = None
+    if self.hasTable():
+      row = self.conn.execute(""
+        + " SELECT dateMillis, dateMillisCount FROM " + IMPORT_CHECKPOINT_TABLE
+        + " WHERE stateKey = ?"
+        + ";", (self.stateKey,)).fetchone()
+    if row == None:
+      print("no " + self.stateKey + " checkpoint in " + IMPORT_CHECKPOINT_TABLE
+        + ", importing everything")
+      return items
+    (self.dateMillis, self.dateMillisCount) = row
+
+    remainingItems = []
+    skipAtDateCount = self.dateMillisCount
+    for item in items:
+      if item.date_millis < self.dateMillis:
+        continue
+      elif item.date_millis == self.dateMillis and skipAtDateCount > 0:
+        skipAtDateCount -= 1
+        continue
+      remainingItems.append(item)
+    print("resuming " + self.stateKey + " import after date_millis=" + str(self.dateMillis)
+      + ", skipping " + str(len(items) - len(remainingItems)) + " of " + str(len(items)))
+    return remainingItems
+  #items were just inserted, in order; commits if COMMIT_EVERY items are uncommitted
+  #  the items of skipImported() before them that were not inserted are counted too
+  def addImported(self, conn, items):
+    for item in items:
+      while self.pendingIndex < len(self.pendingItems):
+        pendingItem = self.pendingItems[self.pendingIndex]
+        self.pendingIndex += 1
+        if pendingItem.date_millis == self.dateMillis:
+          self.dateMillisCount += 1
+        else:
+          self.dateMillis = pendingItem.date_millis
+          self.dateMillisCount = 1
+        if pendingItem is item:
+          break
+    self.uncommittedCount += len(items)
+    if COMMIT_EVERY > 0 and self.uncommittedCount >= COMMIT_EVERY and not NO_COMMIT:
+      self.commit(conn)
+  def commit(self, conn):
+    if self.enabled and self.dateMillis != None:
+      conn.execute(""
+        + " CREATE TABLE IF NOT EXISTS " + IMPORT_CHECKPOINT_TABLE + " ("
+        + "   stateKey TEXT PRIMARY KEY,"
+        + "   dateMillis INTEGER NOT NULL,"
+        + "   dateMillisCount INTEGER NOT NULL"
+        + " );")
+      conn.execute(""
+        + " INSERT OR REPLACE INTO " + IMPORT_CHECKPOINT_TABLE
+        + " (stateKey, dateMillis, dateMillisCount) VALUES (?, ?, ?)"
+        + ";", (self.stateKey, self.dateMillis, self.dateMillisCount))
+    conn.commit()
+    self.uncommittedCount = 0
+  #final commit of a complete import: the checkpoint is no longer needed,
+  #  so remove it, and the table if no other stateKey is left in it
+  def finish(self, conn):
+    if self.hasTable():
+      conn.execute("DELETE FROM " + IMPORT_CHECKPOINT_TABLE + " WHERE stateKey = ?;",
+        (self.stateKey,))
+      if conn.execute("SELECT count(*) FROM " + IMPORT_CHECKPOINT_TABLE + ";").fetchone()[0] == 0:
+        conn.execute("DROP TABLE " + IMPORT_CHECKPOINT_TABLE + ";")
+    conn.commit()
+    self.uncommittedCount = 0
+
+#(remoteUid, endTime, direction, hash(freeText)) of an Events row, for --skip-existing
+def getEventKey(remoteUid, endTime, direction, freeText):
+  if freeText == None:
+    freeText = ""
+  return (remoteUid, endTime, direction, hash(freeText))
+
+def getTextEventKey(txt):
+  return getEventKey(txt.number, int(txt.date_millis/1000),
+    SMS_DIR_EVENT_DIRECTIONS[txt.direction], txt.body)
+
+def getCallEventKey(call):
+  callStartTime = int(call.date_millis/1000)
+  return getEventKey(call.number, callStartTime + call.getDurationSex(),
+    CALL_DIR_EVENT_DIRECTIONS[call.direction], "")
+
+def getMMSEventKey(mms):
+  return getEventKey(mms.from_number, int(mms.date_millis/1000),
+    MMS_DIR_EVENT_DIRECTIONS.get(mms.direction), mms.body)
+
+#drop items already in the DB, with one scan of the Events rows of eventType
+#  items match on getKeyFct(item), or on getMmsIdFct(item) against Events.mmsId
+#  duplicates are counted, so N identical rows in the DB skip at most N identical items
+def skipExistingEvents(cursor, eventType, items, getKeyFct, getMmsIdFct=None):
+  existingKeyCounts = collections.Counter()
+  existingMmsIdCounts = collections.Counter()
+  cleanNumberCache = {}
+  query = cursor.execute(""
+    + " SELECT remoteUid, endTime, direction, freeText, mmsId"
+    + " FROM Events"
+    + " WHERE type = ?"
+    + ";", (eventType,))
+  for (remoteUid, endTime, direction, freeText, mmsId) in query:
+    if remoteUid not in cleanNumberCache:
+      cleanNumberCache[remoteUid] = cleanNumber(remoteUid)
+    existingKeyCounts[getEventKey(
+      cleanNumberCache[remoteUid], endTime, direction, freeText)] += 1
+    if mmsId != None and mmsId != "":
+      existingMmsIdCounts[mmsId] += 1
+
+  newItems = []
+  for item in items:
+    key = getKeyFct(item)
+    mmsId = None
+    if getMmsIdFct != None:
+      mmsId = getMmsIdFct(item)
+    if mmsId != None and existingMmsIdCounts[mmsId] > 0:
+      existingMmsIdCounts[mmsId] -= 1
+      if existingKeyCounts[key] > 0:
+        existingKeyCounts[key] -= 1
+    elif existingKeyCounts[key] > 0:
+      existingKeyCounts[key] -= 1
+    else:
+      newItems.append(item)
 
-  return groupIdByNumber
+  print("skipping {0} of {1} already in DB (--skip-existing)".format(
+    len(items) - len(newItems), len(items)))
+  return newItems
 
 def importSMSToDb(texts, db_file):
-  conn = sqlite3.connect(db_file)
+  conn = connectImportDb(db_file)
   c = conn.cursor()
 
   for txt in texts:
     txt.cleanNumber()
 
+  checkpoint = ImportCheckpoint(conn, "sms")
+  texts = checkpoint.skipImported(texts)
+
+  if SKIP_EXISTING:
+    texts = skipExistingEvents(c, 2, texts, getTextEventKey)
+
   allNumbers = set([txt.number for txt in texts])
-  groupIdByNumber = ensureGroupNumbersInserted(c, allNumbers)
+  groupResolver = getGroupResolver(db_file, c)
+  groupResolver.ensureGroupsInserted(c, [(number,) for number in allNumbers])
+
+  #ids are assigned here instead of read from lastrowid, so EventProperties
+  #  rows can be batched separately from their events
+  eventsSql = prepareInsertSql("events", EVENTS_INSERT_COLS)
+  eventPropsSql = prepareInsertSql("EventProperties", EVENT_PROPERTIES_INSERT_COLS)
+  eventId = getNextAutoIncrementId(c, "events")
 
   startTime = time.time()
   count=0
@@ -1229,91 +2638,113 @@ def importSMSToDb(texts, db_file):
   smsPerSec = 0
   statusMsg = ""
 
-  for txt in texts:
-    groupId = groupIdByNumber[txt.number]
-
-    if txt.isDirection(SMS_DIR.OUT):
-      dir_type = 2
-      status_type = 2
-    elif txt.isDirection(SMS_DIR.INC):
-      dir_type = 1
-      status_type = 0
-
-    messageToken = str(uuid.uuid4())
-
-    #add message to events table
-    insertRow(c, "events", { "type":                  2
-                           , "startTime":             int(txt.date_sent_millis/1000)
-                           , "endTime":               int(txt.date_millis/1000)
-                           , "direction":             dir_type
-                           , "isDraft":               0
-                           , "isRead":                1
-                           , "isMissedCall":          0
-                           , "isEmergencyCall":       0
-                           , "status":                status_type
-                           , "bytesReceived":         0
-                           , "localUid":              LOCAL_UID
-                           , "remoteUid":             txt.number
-                           , "parentId":              ""
-                           , "subject":               ""
-                           , "freeText":              txt.body
-                           , "groupId":               int(groupId)
-                           , "messageToken":          messageToken
-                           , "lastModified":          0
-                           , "vCardFileName":         ""
-                           , "vCardLabel":            ""
-                           , "isDeleted":             ""
-                           , "reportDelivery":        0
-                           , "validityPeriod":        0
-                           , "contentLocation":       ""
-                           , "messageParts":          ""
-                           , "headers":               ""
-                           , "readStatus":            0
-                           , "reportRead":            0
-                           , "reportedReadRequested": 0
-                           , "mmsId":                 ""
-                           , "isAction":              0
-                           })
-    eventId = c.lastrowid
-
-    if txt.date_millis % 1000 > 0:
-      insertRow(c, "EventProperties", { "eventId": eventId
-                                      , "key":     'external_date_millis'
-                                      , "value":   txt.date_millis
-                                      })
-    if txt.date_sent_millis % 1000 > 0:
-      insertRow(c, "EventProperties", { "eventId": eventId
-                                      , "key":     'external_date_sent_millis'
-                                      , "value":   txt.date_sent_millis
-                                      })
-
-    count += 1
-    groupsSeen.add(groupId)
+  for chunk in iterChunks(texts, BATCH_SIZE):
+    eventRows = []
+    eventPropRows = []
+    for txt in chunk:
+      groupId = groupResolver.getGroupId((txt.number,))
+
+      if txt.isDirection(SMS_DIR.OUT):
+        dir_type = 2
+        status_type = 2
+      elif txt.isDirection(SMS_DIR.INC):
+        dir_type = 1
+        status_type = 0
+
+      messageToken = str(uuid.uuid4())
+
+      hasExtraProperties = int(txt.date_millis % 1000 > 0 or txt.date_sent_millis % 1000 > 0)
+
+      #add message to events table
+      eventRows.append({ "id":                    eventId
+                       , "type":                  2
+                       , "startTime":             int(txt.date_sent_millis/1000)
+                       , "endTime":               int(txt.date_millis/1000)
+                       , "direction":             dir_type
+                       , "isDraft":               0
+                       , "isRead":                1
+                       , "isMissedCall":          0
+                       , "isEmergencyCall":       0
+                       , "status":                status_type
+                       , "bytesReceived":         0
+                       , "localUid":              LOCAL_UID
+                       , "remoteUid":             txt.number
+                       , "parentId":              ""
+                       , "subject":               ""
+                       , "freeText":              txt.body
+                       , "groupId":               int(groupId)
+                       , "messageToken":          messageToken
+                       , "lastModified":          0
+                       , "vCardFileName":         ""
+                       , "vCardLabel":            ""
+                       , "isDeleted":             ""
+                       , "reportDelivery":        0
+                       , "validityPeriod":        0
+                       , "contentLocation":       ""
+                       , "messageParts":          ""
+                       , "headers":               ""
+                       , "readStatus":            0
+                       , "reportRead":            0
+                       , "reportedReadRequested": 0
+                       , "mmsId":                 ""
+                       , "isAction":              0
+                       , "hasExtraProperties":    hasExtraProperties
+                       , "hasMessageParts":       0
+                       })
+
+      if txt.date_millis % 1000 > 0:
+        eventPropRows.append({ "eventId": eventId
+                             , "key":     'external_date_millis'
+                             , "value":   txt.date_millis
+                             })
+      if txt.date_sent_millis % 1000 > 0:
+        eventPropRows.append({ "eventId": eventId
+                             , "key":     'external_date_sent_millis'
+                             , "value":   txt.date_sent_millis
+                             })
+
+      eventId += 1
+      groupsSeen.add(groupId)
+
+    c.executemany(eventsSql, eventRows)
+    c.executemany(eventPropsSql, eventPropRows)
+    checkpoint.addImported(conn, chunk)
+
+    count += len(chunk)
     elapsedS = time.time() - startTime
     smsPerSec = int(count / elapsedS + 0.5)
     statusMsg = " {0:6d} SMS for {1:4d} contacts in {2:6.2f}s @ {3:5d} SMS/s".format(
                   count, len(groupsSeen), elapsedS, smsPerSec)
 
-    if count % 100 == 0:
-      sys.stdout.write("\r" + statusMsg)
-      sys.stdout.flush()
+    sys.stdout.write("\r" + statusMsg)
+    sys.stdout.flush()
 
   print("\n\nfinished:\n" + statusMsg)
 
   if not NO_COMMIT:
-    conn.commit()
+    checkpoint.finish(conn)
     print("changes saved to " + db_file)
 
   c.close()
   conn.close()
 
 def importCallsToDb(calls, db_file):
-  conn = sqlite3.connect(db_file)
+  conn = connectImportDb(db_file)
   c = conn.cursor()
 
   for call in calls:
     call.cleanNumber()
 
+  checkpoint = ImportCheckpoint(conn, "calls")
+  calls = checkpoint.skipImported(calls)
+
+  if SKIP_EXISTING:
+    calls = skipExistingEvents(c, 3, calls, getCallEventKey)
+
+  eventsSql = prepareInsertSql("events", EVENTS_INSERT_COLS)
+  eventPropsSql = prepareInsertSql("EventProperties", EVENT_PROPERTIES_INSERT_COLS)
+  eventId = getNextAutoIncrementId(c, "events")
+
   startTime = time.time()
   count=0
   numbersSeen = set()
@@ -1321,98 +2752,137 @@ def importCallsToDb(calls, db_file):
   callsPerSec = 0
   statusMsg = ""
 
-  for call in calls:
-    if call.isDirection(CALL_DIR.OUT):
-      dir_type = 2
-      isMissed = 0
-      headersRejectedHack = ""
-    elif call.isDirection(CALL_DIR.INC):
-      dir_type = 1
-      isMissed = 0
-      headersRejectedHack = ""
-    elif call.isDirection(CALL_DIR.MIS):
-      dir_type = 1
-      isMissed = 1
-      headersRejectedHack = ""
-    elif call.isDirection(CALL_DIR.REJ):
-      dir_type = 1
-      isMissed = 0
-      headersRejectedHack = "rejected"
-
-    startTime = int(call.date_millis/1000)
-    endTime = startTime + call.getDurationSex()
-
-    #add message to events table
-    insertRow(c, "events", { "type":                  3
-                           , "startTime":             startTime
-                           , "endTime":               endTime
-                           , "direction":             dir_type
-                           , "isDraft":               0
-                           , "isRead":                1
-                           , "isMissedCall":          isMissed
-                           , "isEmergencyCall":       0
-                           , "status":                0
-                           , "bytesReceived":         0
-                           , "localUid":              LOCAL_UID
-                           , "remoteUid":             call.number
-                           , "parentId":              ""
-                           , "subject":               ""
-                           , "freeText":              ""
-                           , "groupId":               ""
-                           , "messageToken":          ""
-                           , "lastModified":          startTime
-                           , "vCardFileName":         ""
-                           , "vCardLabel":            ""
-                           , "isDeleted":             ""
-                           , "reportDelivery":        0
-                           , "validityPeriod":        0
-                           , "contentLocation":       ""
-                           , "messageParts":          ""
-                           , "headers":               headersRejectedHack
-                           , "readStatus":            0
-                           , "reportRead":            0
-                           , "reportedReadRequested": 0
-                           , "mmsId":                 ""
-                           , "isAction":              0
-                           })
-    eventId = c.lastrowid
-
-    if call.date_millis % 1000 > 0:
-      insertRow(c, "EventProperties", { "eventId": eventId
-                                      , "key":     'external_date_millis'
-                                      , "value":   call.date_millis
-                                      })
-
-    count += 1
-    numbersSeen.add(call.number)
+  for chunk in iterChunks(calls, BATCH_SIZE):
+    eventRows = []
+    eventPropRows = []
+    for call in chunk:
+      if call.isDirection(CALL_DIR.OUT):
+        dir_type = 2
+        isMissed = 0
+        headersRejectedHack = ""
+      elif call.isDirection(CALL_DIR.INC):
+        dir_type = 1
+        isMissed = 0
+        headersRejectedHack = ""
+      elif call.isDirection(CALL_DIR.MIS):
+        dir_type = 1
+        isMissed = 1
+        headersRejectedHack = ""
+      elif call.isDirection(CALL_DIR.REJ):
+        dir_type = 1
+        isMissed = 0
+        headersRejectedHack = "rejected"
+
+      callStartTime = int(call.date_millis/1000)
+      callEndTime = callStartTime + call.getDurationSex()
+
+      hasExtraProperties = int(call.date_millis % 1000 > 0)
+
+      #add message to events table
+      eventRows.append({ "id":                    eventId
+                       , "type":                  3
+                       , "startTime":             callStartTime
+                       , "endTime":               callEndTime
+                       , "direction":             dir_type
+                       , "isDraft":               0
+                       , "isRead":                1
+                       , "isMissedCall":          isMissed
+                       , "isEmergencyCall":       0
+                       , "status":                0
+                       , "bytesReceived":         0
+                       , "localUid":              LOCAL_UID
+                       , "remoteUid":             call.number
+                       , "parentId":              ""
+                       , "subject":               ""
+                       , "freeText":              ""
+                       , "groupId":               ""
+                       , "messageToken":          ""
+                       , "lastModified":          callStartTime
+                       , "vCardFileName":         ""
+                       , "vCardLabel":            ""
+                       , "isDeleted":             ""
+                       , "reportDelivery":        0
+                       , "validityPeriod":        0
+                       , "contentLocation":       ""
+                       , "messageParts":          ""
+                       , "headers":               headersRejectedHack
+                       , "readStatus":            0
+                       , "reportRead":            0
+                       , "reportedReadRequested": 0
+                       , "mmsId":                 ""
+                       , "isAction":              0
+                       , "hasExtraProperties":    hasExtraProperties
+                       , "hasMessageParts":       0
+                       })
+
+      if call.date_millis % 1000 > 0:
+        eventPropRows.append({ "eventId": eventId
+                             , "key":     'external_date_millis'
+                             , "value":   call.date_millis
+                             })
+
+      eventId += 1
+      numbersSeen.add(call.number)
+
+    c.executemany(eventsSql, eventRows)
+    c.executemany(eventPropsSql, eventPropRows)
+    checkpoint.addImported(conn, chunk)
+
+    count += len(chunk)
     elapsedS = time.time() - startTime
     callsPerSec = int(count / elapsedS + 0.5)
     statusMsg = " {0:6d} calls for {1:4d} contacts in {2:6.2f}s @ {3:5d} calls/s".format(
                   count, len(numbersSeen), elapsedS, callsPerSec)
 
-    if count % 100 == 0:
-      sys.stdout.write("\r" + statusMsg)
-      sys.stdout.flush()
+    sys.stdout.write("\r" + statusMsg)
+    sys.stdout.flush()
 
   print("\n\nfinished:\n" + statusMsg)
 
   if not NO_COMMIT:
-    conn.commit()
+    checkpoint.finish(conn)
     print("changes saved to " + db_file)
 
   c.close()
   conn.close()
 
+#getGroupKey() of the numbers in an MMS other than MY_NUMBER
+#  OUT is to all of to_numbers, INC is from from_number, plus any other to_numbers
+#  without MY_NUMBER, an INC MMS goes in the 1-to-1 group of from_number
+def getMMSGroupKey(mms):
+  if mms.isDirection(MMS_DIR.OUT):
+    return getGroupKey(mms.to_numbers)
+  elif MY_NUMBER == None:
+    return getGroupKey([mms.from_number])
+  else:
+    myNumber = cleanNumber(MY_NUMBER)
+    return getGroupKey([mms.from_number]
+      + [num for num in mms.to_numbers if num != myNumber])
+
 def importMMSToDb(mmsMessages, db_file):
-  conn = sqlite3.connect(db_file)
+  conn = connectImportDb(db_file)
   c = conn.cursor()
 
   for mms in mmsMessages:
     mms.cleanNumbers()
 
+  checkpoint = ImportCheckpoint(conn, "mms")
+  mmsMessages = checkpoint.skipImported(mmsMessages)
+
+  if SKIP_EXISTING:
+    mmsMessages = skipExistingEvents(c, 6, mmsMessages, getMMSEventKey,
+      getMmsIdFct=lambda mms: mms.checksum)
+
   allNumbers = set([mms.from_number for mms in mmsMessages])
   allNumbers.update([to_number for mms in mmsMessages for to_number in mms.to_numbers])
-  groupIdByNumber = ensureGroupNumbersInserted(c, allNumbers)
+  groupResolver = getGroupResolver(db_file, c)
+  groupResolver.ensureGroupsInserted(c, [(number,) for number in allNumbers]
+    + [getMMSGroupKey(mms) for mms in mmsMessages])
+
+  allAttFiles = [(attName, mms.attFiles[attName])
+                 for mms in mmsMessages
+                 for attName in sorted(mms.attFiles.keys())]
+  contentTypeByAttFile = dict(zip(allAttFiles, guessContentTypes(allAttFiles)))
 
   startTime = time.time()
   count=0
@@ -1426,24 +2896,24 @@ def importMMSToDb(mmsMessages, db_file):
       print("ERROR: mms missing 'to' number\n" + str(mms))
       quit(1)
 
-    to_number = mms.to_numbers[0]
-
     toNumsFmt = [maybePrependUSANumber(num) for num in mms.to_numbers]
 
     xMMSToHeader = "x-mms-to\u001D" + "\u001E".join(toNumsFmt)
 
+    groupId = groupResolver.getGroupId(getMMSGroupKey(mms))
     if mms.isDirection(MMS_DIR.OUT):
       dir_type = 2
       status_type = 2
-      groupId = groupIdByNumber[to_number]
     elif mms.isDirection(MMS_DIR.INC):
       dir_type = 1
       status_type = -1
-      groupId = groupIdByNumber[mms.from_number]
     else:
       print("ERROR: unsupported MMS dir type\n" + str(mms))
       quit(1)
 
+    hasExtraProperties = int(mms.date_millis % 1000 > 0 or mms.date_sent_millis % 1000 > 0)
+    hasMessageParts = int(len(mms.attFiles) > 0)
+
     #add message to events table
     insertRow(c, "events", { "type":                  6
                            , "startTime":             int(mms.date_sent_millis/1000)
@@ -1476,6 +2946,8 @@ def importMMSToDb(mmsMessages, db_file):
                            , "reportedReadRequested": 0
                            , "mmsId":                 mms.checksum
                            , "isAction":              0
+                           , "hasExtraProperties":    hasExtraProperties
+                           , "hasMessageParts":       hasMessageParts
                            })
     eventId = c.lastrowid
 
@@ -1495,7 +2967,7 @@ def importMMSToDb(mmsMessages, db_file):
       localFilepath = mms.attFiles[attName]
       remoteFilepath = mms.attFilesRemotePaths[attName]
 
-      contentType = guessContentType(attName, localFilepath)
+      contentType = contentTypeByAttFile[(attName, localFilepath)]
 
       insertRow(c, "messageParts", { "eventId":     eventId
                                    , "contentId":   contentId
@@ -1504,6 +2976,8 @@ def importMMSToDb(mmsMessages, db_file):
                                    })
       contentId += 1
 
+    checkpoint.addImported(conn, [mms])
+
     count += 1
     groupsSeen.add(groupId)
     elapsedS = time.time() - startTime
@@ -1518,57 +2992,97 @@ def importMMSToDb(mmsMessages, db_file):
   print("\n\nfinished:\n" + statusMsg)
 
   if not NO_COMMIT:
-    conn.commit()
+    checkpoint.finish(conn)
     print("changes saved to " + db_file)
 
   c.close()
   conn.close()
 
 def guessContentType(filename, filepath):
-  if regexMatch(r'^.*\.(txt)$', filename, re.IGNORECASE):
-    contentType = "text/plain;charset=utf-8"
-  elif regexMatch(r'^.*\.(jpg|jpeg)$', filename, re.IGNORECASE):
-    contentType = "image/jpeg"
-  elif regexMatch(r'^.*\.(png)$', filename, re.IGNORECASE):
-    contentType = "image/png"
-  elif regexMatch(r'^.*\.(gif)$', filename, re.IGNORECASE):
-    contentType = "image/gif"
-  elif regexMatch(r'^.*\.(wav)$', filename, re.IGNORECASE):
-    contentType = "audio/wav"
-  elif regexMatch(r'^.*\.(flac)$', filename, re.IGNORECASE):
-    contentType = "audio/flac"
-  elif regexMatch(r'^.*\.(ogg)$', filename, re.IGNORECASE):
-    contentType = "audio/ogg"
-  elif regexMatch(r'^.*\.(mp3|mp2|m2a|mpga)$', filename, re.IGNORECASE):
-    contentType = "audio/mpeg"
-  elif regexMatch(r'^.*\.(mp4)$', filename, re.IGNORECASE):
-    contentType = "video/mp4"
-  elif regexMatch(r'^.*\.(mkv)$', filename, re.IGNORECASE):
-    contentType = "video/x-matroska"
-  elif regexMatch(r'^.*\.(webm)$', filename, re.IGNORECASE):
-    contentType = "video/webm"
-  elif regexMatch(r'^.*\.(mpg|mpeg|m1v|m2v)$', filename, re.IGNORECASE):
-    contentType = "video/mpeg"
-  elif regexMatch(r'^.*\.(avi)$', filename, re.IGNORECASE):
-    contentType = "video/avi"
-  elif regexMatch(r'^.*\.(3gp)$', filename, re.IGNORECASE):
-    contentType = "video/3gpp"
-  elif regexMatch(r'^.*\.(amr)$', filename, re.IGNORECASE):
-    contentType = "audio/AMR"
-  else:
-    mimeType = result = subprocess.check_output([ "file"
-                                                , "--mime"
-                                                , "--brief"
-                                                , filepath
-                                                ])
-    mimeType = regexSub(r';.*', '', mimeType)
-    if regexMatch(r'^[a-z0-9]+/[a-z0-9\-.]+$', mimeType):
-      return mimeType
+  return guessContentTypes([(filename, filepath)])[0]
+
+#attFiles is a list of (filename, filepath), returns a contentType for each
+#  -by file extension
+#  -by sniffing the first few bytes, memoized by sha256 for the whole run
+#  -by `file --mime`, run once for all the files still unknown
+def guessContentTypes(attFiles):
+  contentTypes = [None] * len(attFiles)
+  unknownIdxs = []
+  for i in range(len(attFiles)):
+    (filename, filepath) = attFiles[i]
+    (base, dot, ext) = filename.rpartition('.')
+    if dot != "" and ext.lower() in CONTENT_TYPES_BY_EXT:
+      contentTypes[i] = CONTENT_TYPES_BY_EXT[ext.lower()]
     else:
+      unknownIdxs.append(i)
+
+  if len(unknownIdxs) == 0:
+    return contentTypes
+
+  hashIndex = FileHashIndex(HASH_CACHE_FILE)
+  unknownSHA256s = hashIndex.sha256Files([attFiles[i][1] for i in unknownIdxs])
+  hashIndex.close()
+
+  fileCmdFilesBySHA256 = {}
+  for (i, sha256) in zip(unknownIdxs, unknownSHA256s):
+    if sha256 not in CONTENT_TYPES_BY_SHA256:
+      contentType = sniffContentType(attFiles[i][1])
+      if contentType != None:
+        CONTENT_TYPES_BY_SHA256[sha256] = contentType
+      elif sha256 not in fileCmdFilesBySHA256:
+        fileCmdFilesBySHA256[sha256] = attFiles[i][1]
+
+  fileCmdSHA256s = sorted(fileCmdFilesBySHA256.keys())
+  fileCmdFiles = [fileCmdFilesBySHA256[sha256] for sha256 in fileCmdSHA256s]
+  for (sha256, filepath, mimeType) in zip(
+      fileCmdSHA256s, fileCmdFiles, readFileCmdMimeTypes(fileCmdFiles)):
+    if not MIME_TYPE_REGEX.match(mimeType):
       print("unknown file type: " + filepath)
       quit(1)
-
-  return contentType
+    CONTENT_TYPES_BY_SHA256[sha256] = mimeType
+
+  for (i, sha256) in zip(unknownIdxs, unknownSHA256s):
+    contentTypes[i] = CONTENT_TYPES_BY_SHA256[sha256]
+  return contentTypes
+
+#None if not recognized
+def sniffContentType(filepath):
+  with open(filepath, 'rb') as f:
+    head = f.read(MAGIC_SNIFF_BYTES)
+
+  if head.startswith(b'%PDF-'):
+    return "application/pdf"
+  elif head.startswith(b'#!AMR'):
+    return "audio/AMR"
+  elif head[4:8] == b'ftyp':
+    brand = head[8:12]
+    if brand.startswith(b'3g2'):
+      return "video/3gpp2"
+    elif brand.startswith(b'3g'):
+      return "video/3gpp"
+    elif brand in [b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx']:
+      return "image/heic"
+    elif brand in [b'mif1', b'msf1']:
+      return "image/heif"
+
+  text = head.lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+  if text.startswith(b'begin:vcard'):
+    return "text/vcard"
+  elif text.startswith(b'<smil') or (text.startswith(b'<') and b'<smil' in text):
+    return "application/smil"
+  return None
+
+#`file --mime --brief`, one process per FILE_CMD_MAX_ARGS files
+def readFileCmdMimeTypes(filepaths):
+  mimeTypes = []
+  for chunk in iterChunks(filepaths, FILE_CMD_MAX_ARGS):
+    out = subprocess.check_output(["file", "--mime", "--brief", "--"] + chunk)
+    lines = out.decode("utf-8").splitlines()
+    if len(lines) != len(chunk):
+      print("ERROR: could not parse output of `file --mime` for:\n" + "\n".join(chunk))
+      quit(1)
+    mimeTypes.extend([line.split(";")[0].strip() for line in lines])
+  return mimeTypes
 
 def uniq(items):
   seen = set()
@@ -1580,20 +3094,33 @@ def uniq(items):
   return uniqItems
 
 def convertToStr(string):
+  if type(string) == str:
+    return string
   if type(string) == bytes:
     string = string.decode("utf-8")
   if type(string) != str:
     string = str(string)
   return string
 
+#pattern is a compiled re.Pattern (used as-is), or a str compiled once per (pattern, flags)
+def getRegex(pattern, flags=0):
+  if type(pattern) == re.Pattern:
+    return pattern
+  key = (pattern, flags)
+  regex = REGEX_CACHE.get(key)
+  if regex == None:
+    regex = re.compile(pattern, flags)
+    REGEX_CACHE[key] = regex
+  return regex
+
 def regexMatch(pattern, string, flags=0):
-  return re.match(pattern, convertToStr(string), flags=flags)
+  return getRegex(pattern, flags).match(convertToStr(string))
 
 def regexSub(pattern, repl, string, count=0, flags=0):
-  return re.sub(pattern, repl, convertToStr(string), count=count, flags=flags)
+  return getRegex(pattern, flags).sub(repl, convertToStr(string), count=count)
 
 def regexSplit(pattern, string, maxsplit=0, flags=0):
-  return re.split(pattern, convertToStr(string), maxsplit=maxsplit, flags=flags)
+  return getRegex(pattern, flags).split(convertToStr(string), maxsplit=maxsplit)
 
 if __name__ == '__main__':
   main()